@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark how fast a new leader rebuilds its state from relation data.
+
+Relates many grafana-source applications (and a database) while the unit
+is not the leader, then times the leader-elected rebuild.
+
+    PYTHONPATH=src python3 benchmarks/bench_leader_failover.py --relations 1000
+"""
+
+import argparse
+import logging
+import time
+
+from ops.testing import Harness
+
+from charm import GrafanaK8s
+
+
+def setup_harness(relations, units):
+    harness = Harness(GrafanaK8s)
+    harness.begin()
+    harness.update_config({'grafana_image_path': 'grafana/grafana:latest'})
+    with harness.hooks_disabled():
+        for index in range(relations):
+            app = 'prometheus-{}'.format(index)
+            rel_id = harness.add_relation('grafana-source', app)
+            for unit_index in range(units):
+                unit = '{}/{}'.format(app, unit_index)
+                harness.add_relation_unit(rel_id, unit)
+                harness.update_relation_data(rel_id, unit, {
+                    'private-address': '10.{}.{}.{}'.format(
+                        index // 65536 % 256, index // 256 % 256, index % 256),
+                    'port': '9090',
+                    'source-type': 'prometheus',
+                    'source-name': app,
+                })
+        rel_id = harness.add_relation('database', 'mysql')
+        harness.add_relation_unit(rel_id, 'mysql/0')
+        harness.update_relation_data(rel_id, 'mysql/0', {
+            'type': 'mysql',
+            'host': '10.0.0.1:3306',
+            'name': 'grafana',
+            'user': 'grafana',
+            'password': 'password',
+        })
+    return harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--relations', type=int, default=1000)
+    parser.add_argument('--units', type=int, default=1,
+                        help='units per grafana-source relation')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    harness = setup_harness(args.relations, args.units)
+
+    start = time.monotonic()
+    harness.set_leader(True)  # rebuilds the datastore and sets the pod spec
+    failover = time.monotonic() - start
+
+    start = time.monotonic()
+    harness.charm._rebuild_datastore_from_relations()
+    rebuild = time.monotonic() - start
+
+    print('relations={} units={} sources={} failover={:.3f}s '
+          'rebuild only={:.3f}s'.format(
+              args.relations, args.units,
+              len(harness.charm.datastore.sources), failover, rebuild))
+    harness.cleanup()
+
+
+if __name__ == '__main__':
+    main()
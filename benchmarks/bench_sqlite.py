@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark concurrent dashboard saves against a local sqlite3 file.
+
+Compares the sqlite3 defaults Grafana uses in single node mode with the
+settings rendered by `sqlite_performance_mode` (WAL journaling, shared
+cache and retries on a locked database).
+
+    python3 benchmarks/bench_sqlite.py --writers 8 --writes 200
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+PROFILES = {
+    'default': {'journal_mode': 'DELETE', 'cache': 'private', 'retries': 0},
+    'performance': {'journal_mode': 'WAL', 'cache': 'shared', 'retries': 5},
+}
+
+DASHBOARD_SIZE = 16 * 1024  # bytes of JSON in a typical saved dashboard
+
+
+def connect(db_path, profile):
+    uri = 'file:{}?cache={}&mode=rwc'.format(db_path, profile['cache'])
+    return sqlite3.connect(uri, uri=True, timeout=0, isolation_level=None,
+                           check_same_thread=False)
+
+
+def with_retries(connection, retries, statements):
+    """Run statements in one transaction, retrying while the db is locked."""
+    for attempt in range(retries + 1):
+        try:
+            connection.execute('BEGIN')
+            for sql, args in statements:
+                connection.execute(sql, args).fetchall()
+            connection.execute('COMMIT')
+            return True
+        except sqlite3.OperationalError:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            # back off between retries like Grafana does
+            time.sleep(0.001 * (attempt + 1))
+    return False
+
+
+def worker(db_path, profile, writes, stats, lock):
+    connection = connect(db_path, profile)
+    payload = 'x' * DASHBOARD_SIZE
+    saved = failed = 0
+    for _ in range(writes):
+        save = ('INSERT OR REPLACE INTO dashboard (id, data) VALUES (?, ?)',
+                (random.randint(0, 1000), payload))
+        if with_retries(connection, profile['retries'], [save]):
+            saved += 1
+        else:
+            failed += 1
+        # dashboards are read far more often than they are written
+        read = ('SELECT count(*) FROM dashboard', ())
+        if not with_retries(connection, profile['retries'], [read] * 4):
+            failed += 1
+    connection.close()
+    with lock:
+        stats['saved'] += saved
+        stats['failed'] += failed
+
+
+def run(profile_name, writers, writes):
+    profile = PROFILES[profile_name]
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'grafana.db')
+        setup = connect(db_path, profile)
+        setup.execute('PRAGMA journal_mode={}'.format(profile['journal_mode']))
+        setup.execute('CREATE TABLE dashboard (id INTEGER PRIMARY KEY, data TEXT)')
+        setup.close()
+
+        stats = {'saved': 0, 'failed': 0}
+        lock = threading.Lock()
+        threads = [threading.Thread(target=worker,
+                                    args=(db_path, profile, writes, stats, lock))
+                   for _ in range(writers)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+
+    print('{:<12} saved={:<6} failed={:<6} time={:.3f}s saves/s={:.0f}'.format(
+        profile_name, stats['saved'], stats['failed'], duration,
+        stats['saved'] / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=200)
+    args = parser.parse_args()
+    for profile_name in PROFILES:
+        run(profile_name, args.writers, args.writes)
+
+
+if __name__ == '__main__':
+    main()
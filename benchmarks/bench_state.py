@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark the size and commit time of the charm's StoredState.
+
+Compares the dictionary layout of schema version 1 with the compact
+records of the current schema for a large number of data sources.
+
+    PYTHONPATH=src python3 benchmarks/bench_state.py --sources 1000 10000
+"""
+
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+from ops.storage import SQLiteStorage
+
+from charm import pack_database, pack_source
+
+DATABASE = {
+    'type': 'mysql',
+    'host': '10.0.0.1:3306',
+    'name': 'grafana',
+    'user': 'grafana',
+    'password': 'password',
+}
+
+
+def make_source(index):
+    app = 'prometheus-{}'.format(index)
+    # relation data arrives as separate string objects for every source
+    return {
+        'private-address': '10.{}.{}.{}'.format(
+            index // 65536 % 256, index // 256 % 256, index % 256),
+        'port': str(9090),
+        'source-name': app,
+        'source-type': ''.join(['prom', 'etheus']),
+        'unit_name': '{}/0'.format(app),
+        'version': 1,
+    }
+
+
+def v1_snapshot(count):
+    sources = {}
+    for index in range(count):
+        source = make_source(index)
+        source['isDefault'] = 'true' if index == 0 else 'false'
+        del source['version']
+        sources[index] = source
+    return {'sources': sources, 'database': dict(DATABASE)}
+
+
+def v2_snapshot(count):
+    return {
+        'sources': {index: pack_source(make_source(index))
+                    for index in range(count)},
+        'database': pack_database(DATABASE),
+    }
+
+
+def commit_time(snapshot, commits):
+    """Average time to save and commit the snapshot like ops does per hook."""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(os.path.join(tmp, 'state.db'))
+        start = time.monotonic()
+        for _ in range(commits):
+            storage.save_snapshot('GrafanaK8s/StoredStateData[datastore]',
+                                  snapshot)
+            storage.commit()
+        duration = (time.monotonic() - start) / commits
+        storage.close()
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sources', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--commits', type=int, default=20)
+    args = parser.parse_args()
+
+    for count in args.sources:
+        for schema, make_snapshot in (('v1', v1_snapshot), ('v2', v2_snapshot)):
+            snapshot = make_snapshot(count)
+            size = len(pickle.dumps(snapshot))
+            print('sources={:<6} schema={} size={:>9} bytes '
+                  'commit={:.2f}ms'.format(
+                      count, schema, size,
+                      commit_time(snapshot, args.commits) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,30 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-# TODO: to ensure HA works properly, add datasource version increments
-#       https://grafana.com/docs/grafana/latest/administration/provisioning/#running-multiple-grafana-instances
 # TODO: create actions that will help users. e.g. "upload-dashboard"
 
+import base64
+import concurrent.futures
+import http.client
 import logging
 import hashlib
+import json
+import os
+import sqlite3
+import ssl
+import sys
 import textwrap
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
 
 # from oci_image import OCIImageResource, OCIImageResourceError
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, MaintenanceStatus, BlockedStatus
+from ops.model import ActiveStatus, MaintenanceStatus, BlockedStatus, ModelError
 
 log = logging.getLogger()
 
@@ -33,6 +44,25 @@ OPTIONAL_DATASOURCE_FIELDS = {
     'source-name',  # a human-readable name of the source
 }
 
+# how the data source URL of a (per-unit) grafana-source is built
+# unit: the address of the unit that provided the data source
+# service: a stable address load balancing across all units of the
+#          source application, its 'service-address' field or otherwise
+#          the Kubernetes service of the application
+VALID_SOURCE_URL_MODES = {'unit', 'service'}
+SERVICE_ADDRESS_FIELD = 'service-address'
+
+# what to do with data sources that don't answer HTTP requests
+# off: don't probe them, mark: report them in the unit status,
+# hold: also leave them out of datasources.yaml until they answer
+VALID_DATASOURCE_VALIDATION_MODES = {'off', 'mark', 'hold'}
+DATASOURCE_PROBE_MAX_WORKERS = 16
+
+# application databag key of the grafana-source protocol v2: a JSON list
+# of data sources with the fields above, where 'source-name' is required.
+# It takes precedence over the per-unit fields of protocol v1.
+BATCHED_DATASOURCES_KEY = 'datasources'
+
 # https://grafana.com/docs/grafana/latest/administration/configuration/#database
 REQUIRED_DATABASE_FIELDS = {
     'type',  # mysql, postgres or sqlite3 (sqlite3 doesn't work for HA)
@@ -49,6 +79,109 @@ OPTIONAL_DATABASE_FIELDS = set()
 
 VALID_DATABASE_TYPES = {'mysql', 'postgres', 'sqlite3'}
 
+# redis relation fields used as the Grafana Live HA engine
+# https://grafana.com/docs/grafana/latest/setup-grafana/set-up-grafana-live/#configure-grafana-live
+REQUIRED_REDIS_FIELDS = {
+    'hostname',  # the hostname/IP of the redis server
+    'port',
+}
+OPTIONAL_REDIS_FIELDS = {
+    'password',
+}
+
+# layout of the charm's StoredState, see GrafanaK8s._migrate_datastore()
+# 1) data sources and database config stored as dictionaries
+# 2) data sources and database config stored as compact records
+# 3) default data source stored by name
+STATE_SCHEMA_VERSION = 3
+
+# field order of the data source and database records in StoredState
+SOURCE_RECORD_FIELDS = (
+    'source-name',
+    'source-type',
+    'private-address',
+    'port',
+    'unit_name',  # None if it is the same as 'source-name'
+    'version',
+)
+DATABASE_RECORD_FIELDS = ('type', 'host', 'name', 'user', 'password')
+
+# https://grafana.com/docs/grafana/latest/administration/configuration/#cache_mode
+VALID_SQLITE_CACHE_MODES = {'private', 'shared'}
+
+# https://grafana.com/docs/grafana/latest/administration/configuration/#log
+VALID_LOG_MODES = {'console', 'file', 'syslog'}
+VALID_LOG_LEVELS = {'debug', 'info', 'warn', 'error', 'critical'}
+VALID_LOG_CONSOLE_FORMATS = {'text', 'console', 'json'}
+
+# https://grafana.com/docs/grafana/latest/administration/configuration/#server
+VALID_SERVER_PROTOCOLS = {'http', 'https', 'h2'}
+TLS_SERVER_PROTOCOLS = {'https', 'h2'}  # need a certificate and key
+TLS_MOUNT_PATH = '/etc/grafana/tls'
+TLS_CERT_FILE = 'grafana.crt'
+# the private key is mounted from a Kubernetes Secret, as pod spec files
+# end up in ConfigMaps readable by anyone who may read ConfigMaps
+TLS_KEY_MOUNT_PATH = '/etc/grafana/tls-key'
+TLS_KEY_FILE = 'grafana.key'
+
+# file name of the sqlite3 database, relative to the `sqlitedb` storage
+SQLITE_DATABASE_FILE = 'grafana.db'
+
+# container config keys holding the hashes of the generated config files
+# a change to any of these triggers a rollout of the Grafana pods
+CONFIG_HASH_KEYS = ('DATASOURCES_YAML', 'GRAFANA_INI', 'GRAFANA_TLS',
+                    'QUERY_CACHE_CONFIG')
+
+# GrafanaK8s methods adding the config files to the pod spec, in the order
+# `_build_pod_spec_with_files()` calls them (render.py times each of them)
+POD_SPEC_FILE_UPDATERS = (
+    '_update_pod_data_source_config_file',
+    '_update_pod_config_ini_file',
+    '_update_pod_tls_files',
+    '_update_pod_query_cache_sidecar',
+)
+
+# peer app databag key of the application state published by the leader
+# (data sources, database config, config hashes and restart generation)
+SHARED_STATE_KEY = 'grafana-state'
+SHARED_STATE_VERSION = 1
+
+# peer unit databag key used to roll out restarts across HA replicas
+# every unit acknowledges the restart generation of the shared state
+# once its Grafana is healthy again
+RESTART_ACK_KEY = 'restart-ack'
+
+# a data source in datasources.yaml, dedented once instead of on every render
+DATASOURCE_TEMPLATE = textwrap.dedent("""
+    - name: {0}
+      type: {1}
+      access: proxy
+      url: {2}
+      isDefault: {3}
+      editable: true
+      orgId: 1
+      version: {4}
+      basicAuthUser: {5}
+      secureJsonData:
+        basicAuthPassword: {6}""")
+
+# query cache sidecar in front of Prometheus data sources, see query_cache.py
+QUERY_CACHE_CONTAINER = 'query-cache'
+QUERY_CACHE_MOUNT_PATH = '/etc/grafana-query-cache'
+QUERY_CACHE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'query_cache.py')
+QUERY_CACHE_SOURCE_TYPES = {'prometheus'}
+
+# every `files` entry of the pod spec becomes a Kubernetes ConfigMap, which
+# (like the pod spec itself) can not be larger than 1MiB
+CONFIGMAP_SIZE_LIMIT = 1024 * 1024
+
+# fraction of `pod_spec_size_budget` at which a warning is logged
+POD_SPEC_SIZE_WARNING_RATIO = 0.8
+
+# seconds to wait for a response of Grafana's /api/health endpoint
+HEALTH_CHECK_TIMEOUT = 5
+
 # statuses
 APPLICATION_ACTIVE_STATUS = ActiveStatus('Grafana pod ready.')
 
@@ -74,6 +207,176 @@ def get_container(pod_spec, container_name):
         container_name))
 
 
+def source_key(rel_id, name=None):
+    """Get the datastore key of a data source.
+
+    A relation using the per-unit protocol has a single data source keyed
+    by the relation id, data sources published as a batch by an
+    application are keyed by relation id and source name.
+    """
+    return rel_id if name is None else '{}/{}'.format(rel_id, name)
+
+
+def parse_source_key(text):
+    """Get a datastore key back from its string form."""
+    return int(text) if text.isdigit() else text
+
+
+def pack_source(source):
+    """Turn a data source dictionary into a compact StoredState record."""
+    record = [source.get(field) for field in SOURCE_RECORD_FIELDS]
+
+    # there are only a few source types, so intern them to have pickle
+    # store each of them once instead of once per source
+    record[1] = sys.intern(record[1])
+
+    # sources without a human readable name are named after their unit
+    if record[4] == record[0]:
+        record[4] = None
+    return record
+
+
+def unpack_source(record):
+    """Turn a record created by `pack_source()` back into a dictionary."""
+    source = dict(zip(SOURCE_RECORD_FIELDS, record))
+    if source['unit_name'] is None:
+        source['unit_name'] = source['source-name']
+    return source
+
+
+def pack_database(database):
+    """Turn a database config dictionary into a compact StoredState record."""
+    if not database:
+        return []
+    return [database[field] for field in DATABASE_RECORD_FIELDS]
+
+
+def unpack_database(record):
+    """Turn a record created by `pack_database()` back into a dictionary."""
+    return dict(zip(DATABASE_RECORD_FIELDS, record))
+
+
+def encode_shared_state(state):
+    """Serialize state to a compact, compressed string for a relation databag.
+
+    The output is deterministic, so it only changes if the state does.
+    """
+    text = json.dumps(state, sort_keys=True, separators=(',', ':'))
+    return base64.b64encode(zlib.compress(text.encode(), 9)).decode()
+
+
+def decode_shared_state(text):
+    """Deserialize a string created by `encode_shared_state()`.
+
+    Returns an empty dictionary if the text can not be decoded or was
+    written with another version of the state format.
+    """
+    try:
+        state = json.loads(zlib.decompress(base64.b64decode(text)).decode())
+    except (ValueError, zlib.error) as e:
+        log.warning('Unable to decode shared state: {}'.format(e))
+        return {}
+
+    if state.get('version') != SHARED_STATE_VERSION:
+        log.warning('Ignoring shared state of version {}'.format(
+            state.get('version')))
+        return {}
+    return state
+
+
+def get_config_hashes(pod_spec):
+    """Get the config file hashes of all containers of a pod spec."""
+    return {key: container['config'][key]
+            for container in pod_spec['containers']
+            for key in CONFIG_HASH_KEYS if key in container['config']}
+
+
+def pod_spec_size(pod_spec):
+    """Measure the rendered size of a pod spec and its file entries.
+
+    Returns the size of the whole spec and a dictionary with the size of
+    every `files` entry (keyed by its name), all in bytes.
+    """
+    file_sizes = {}
+    for container in pod_spec['containers']:
+        for file_meta in container.get('files', []):
+            file_sizes[file_meta['name']] = sum(
+                len(text.encode())
+                for text in file_meta.get('files', {}).values())
+    # JSON is close to the size Juju stores and much faster to render than
+    # YAML, which matters as this runs for every pod spec that is set
+    total = len(json.dumps(pod_spec, separators=(',', ':')).encode())
+    return total, file_sizes
+
+
+def probe_endpoint(address, port, timeout):
+    """Check whether an HTTP server answers on address and port.
+
+    Any HTTP response counts, even an error status, as data sources
+    don't share a common health endpoint.
+    """
+    url = 'http://{}:{}/'.format(address, port)
+    try:
+        with urllib.request.urlopen(url, timeout=timeout):
+            return True
+    except urllib.error.HTTPError:
+        return True
+    except (OSError, http.client.HTTPException) as e:
+        log.debug('Probing {} failed: {}'.format(url, e))
+        return False
+
+
+def probe_endpoints(endpoints, timeout,
+                    max_workers=DATASOURCE_PROBE_MAX_WORKERS):
+    """Probe (address, port) endpoints concurrently.
+
+    Returns a dictionary of whether each endpoint answered, which takes
+    about `timeout` seconds for any number of dead endpoints (up to
+    max_workers).
+    """
+    endpoints = sorted(set(endpoints))
+    if not endpoints:
+        return {}
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(max_workers, len(endpoints))) as executor:
+        results = executor.map(
+            lambda endpoint: probe_endpoint(*endpoint, timeout), endpoints)
+        return dict(zip(endpoints, results))
+
+
+def sqlite_maintenance(db_path, vacuum=True, analyze=True):
+    """Run VACUUM and/or ANALYZE on the sqlite3 database at db_path.
+
+    Returns a dictionary with the file size before and after the
+    maintenance and how long it took (in seconds).
+    """
+    if not os.path.isfile(db_path):
+        raise FileNotFoundError(
+            "No sqlite3 database found at '{}'".format(db_path))
+
+    size_before = os.path.getsize(db_path)
+    start = time.monotonic()
+
+    # isolation_level=None is needed because VACUUM can not
+    # be run inside of a transaction
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        if vacuum:
+            connection.execute('VACUUM')
+        if analyze:
+            connection.execute('ANALYZE')
+            connection.execute('PRAGMA optimize')
+    finally:
+        connection.close()
+
+    return {
+        'size-before': size_before,
+        'size-after': os.path.getsize(db_path),
+        'duration': round(time.monotonic() - start, 3),
+    }
+
+
 class GrafanaK8s(CharmBase):
     """Charm to run Grafana on Kubernetes.
 
@@ -93,6 +396,12 @@ class GrafanaK8s(CharmBase):
         # -- standard hooks
         self.framework.observe(self.on.config_changed, self.on_config_changed)
         self.framework.observe(self.on.update_status, self.on_update_status)
+        self.framework.observe(self.on.leader_elected, self.on_leader_elected)
+        self.framework.observe(self.on.collect_metrics, self.on_collect_metrics)
+
+        # -- actions
+        self.framework.observe(self.on.sqlite_maintenance_action,
+                               self.on_sqlite_maintenance_action)
 
         # -- grafana-source relation observations
         self.framework.observe(self.on['grafana-source'].relation_changed,
@@ -112,34 +421,268 @@ class GrafanaK8s(CharmBase):
         self.framework.observe(self.on['database'].relation_departed,
                                self.on_database_departed)
 
+        # -- redis relation observations
+        self.framework.observe(self.on['redis'].relation_changed,
+                               self.on_redis_changed)
+        self.framework.observe(self.on['redis'].relation_departed,
+                               self.on_redis_departed)
+
         # -- initialize states --
-        self.datastore.set_default(sources=dict())  # available data sources
+        self._migrate_datastore()
+        self.datastore.set_default(schema_version=STATE_SCHEMA_VERSION)
+        # available data sources as records, see `pack_source()`
+        self.datastore.set_default(sources=dict())
         self.datastore.set_default(source_names=set())  # unique source names
-        self.datastore.set_default(sources_to_delete=set())
-        self.datastore.set_default(database=dict())  # db configuration
+        self.datastore.set_default(default_source='')  # name of the default
+        self.datastore.set_default(source_versions=dict())  # name: version
+        # hashes of the rendered data source entries the versions belong to
+        self.datastore.set_default(source_hashes=dict())  # name: md5 hex
+        # names of deleted sources: restart generation they were applied in
+        self.datastore.set_default(tombstones=dict())
+        # db configuration as a record, see `pack_database()`
+        self.datastore.set_default(database=list())
+        self.datastore.set_default(config_hashes=dict())  # applied hashes
+        self.datastore.set_default(restart_generation=0)
+        self.datastore.set_default(restart_started=0.0)  # unix timestamp
+        self.datastore.set_default(pod_spec_size=0)  # bytes of the last spec
+        # redis of the Grafana Live HA engine as 'host:port' and password
+        self.datastore.set_default(redis_address='')
+        self.datastore.set_default(redis_password='')
+        # data source probes by 'address:port': [reachable, unix timestamp]
+        self.datastore.set_default(probe_results=dict())
+        # source_url_mode the data sources in the datastore were built with
+        self.datastore.set_default(source_url_mode='unit')
+
+    def _migrate_datastore(self):
+        """Migrate StoredState written by older versions of this charm."""
+        try:
+            schema_version = self.datastore.schema_version
+        except AttributeError:
+            try:
+                self.datastore.sources
+            except AttributeError:
+                return  # nothing stored yet
+            schema_version = 1
+
+        if schema_version < 2:
+            log.info('Migrating StoredState to schema version 2.')
+            self._migrate_datastore_v1()
+        if schema_version < 3:
+            log.info('Migrating StoredState to schema version 3.')
+            self._migrate_datastore_v2()
+        if schema_version != STATE_SCHEMA_VERSION:
+            self.datastore.schema_version = STATE_SCHEMA_VERSION
+
+    def _migrate_datastore_v1(self):
+        """Turn data source and database dictionaries into records."""
+        for source in self.datastore.sources.values():
+            if source.get('isDefault') == 'true':
+                self.datastore.default_source = source['source-name']
+        self.datastore.sources = {
+            rel_id: pack_source(dict(source, version=source.get('version', 1)))
+            for rel_id, source in self.datastore.sources.items()}
+        self.datastore.set_default(source_versions=dict())
+        for source in self.sources.values():
+            self.datastore.source_versions[source['source-name']] = \
+                source['version']
+        self.datastore.database = pack_database(self.datastore.database)
+
+        # deleted source names were kept in an unversioned set
+        try:
+            sources_to_delete = self.datastore.sources_to_delete
+        except AttributeError:
+            return
+        self.datastore.set_default(tombstones=dict())
+        for name in sources_to_delete:
+            self.datastore.tombstones.setdefault(name, 0)
+        sources_to_delete.clear()
+
+    def _migrate_datastore_v2(self):
+        """Store the default data source, which was the first by name."""
+        self.datastore.set_default(default_source=min(
+            (source['source-name'] for source in self.sources.values()),
+            default=''))
 
     @property
     def has_peer(self) -> bool:
         rel = self.model.get_relation('grafana')
         return len(rel.units) > 0 if rel is not None else False
 
+    @property
+    def sources(self) -> dict:
+        """Get all data sources as dictionaries, see `source_key()`."""
+        return {key: unpack_source(record)
+                for key, record in self.datastore.sources.items()}
+
+    @property
+    def database(self) -> dict:
+        """Get the database config as a dictionary."""
+        return unpack_database(self.datastore.database)
+
+    @property
+    def uses_tls(self) -> bool:
+        """Whether Grafana serves HTTPS (or HTTP/2, which requires TLS)."""
+        return self.model.config['server_protocol'] in TLS_SERVER_PROTOCOLS
+
+    def _get_source(self, key):
+        """Get a data source as a dictionary, or None."""
+        record = self.datastore.sources.get(key)
+        return None if record is None else unpack_source(record)
+
     @property
     def has_db(self) -> bool:
         """Only consider a DB connection if we have config info."""
+        if not self.unit.is_leader():
+            return len(self._shared_state().get('database', {})) > 0
         return len(self.datastore.database) > 0
 
+    @property
+    def has_redis(self) -> bool:
+        """Whether Grafana Live can use a related redis as HA engine."""
+        if not self.unit.is_leader():
+            return bool(self._shared_state().get('redis_address'))
+        return bool(self.datastore.redis_address)
+
+    def _shared_state(self) -> dict:
+        """Get the application state the leader published to its peers."""
+        rel = self.model.get_relation('grafana')
+        if rel is None or SHARED_STATE_KEY not in rel.data[self.app]:
+            return {}
+        return decode_shared_state(rel.data[self.app][SHARED_STATE_KEY])
+
+    def _publish_shared_state(self):
+        """Publish the leader's application state in the peer app databag.
+
+        Peers read this single key instead of scanning all relations.
+        It is only written if it changed, as every write triggers a
+        relation-changed hook on all peers.
+        """
+        rel = self.model.get_relation('grafana')
+        if rel is None:
+            return
+
+        state = {
+            'version': SHARED_STATE_VERSION,
+            'sources': {str(key): source for key, source
+                        in self.sources.items()},
+            'source_versions': dict(self.datastore.source_versions),
+            'source_hashes': dict(self.datastore.source_hashes),
+            'default_source': self.datastore.default_source,
+            'tombstones': dict(self.datastore.tombstones),
+            'database': self.database,
+            'redis_address': self.datastore.redis_address,
+            'redis_password': self.datastore.redis_password,
+            'config_hashes': dict(self.datastore.config_hashes),
+            'restart_generation': self.datastore.restart_generation,
+            'restart_started': self.datastore.restart_started,
+        }
+        text = encode_shared_state(state)
+        if rel.data[self.app].get(SHARED_STATE_KEY) != text:
+            rel.data[self.app][SHARED_STATE_KEY] = text
+
+    def _restore_shared_state(self):
+        """Take over the state published by the previous leader.
+
+        This unit's own StoredState may be empty or stale if it was not
+        the leader before. Restoring the published state keeps the data
+        source versions, tombstones and restart generation consistent.
+        """
+        state = self._shared_state()
+        if not state \
+                or state['restart_generation'] < self.datastore.restart_generation:
+            return
+
+        log.info('Restoring shared state of restart generation {}.'.format(
+            state['restart_generation']))
+        self.datastore.sources = {parse_source_key(key): pack_source(source)
+                                  for key, source in state['sources'].items()}
+        self.datastore.source_names = {
+            source['source-name'] for source in state['sources'].values()}
+        self.datastore.source_versions = state['source_versions']
+        self.datastore.source_hashes = state.get('source_hashes', {})
+        self.datastore.default_source = state.get('default_source') or min(
+            self.datastore.source_names, default='')
+        self.datastore.tombstones = state['tombstones']
+        self.datastore.database = pack_database(state['database'])
+        self.datastore.redis_address = state.get('redis_address', '')
+        self.datastore.redis_password = state.get('redis_password', '')
+        self.datastore.config_hashes = state['config_hashes']
+        self.datastore.restart_generation = state['restart_generation']
+        self.datastore.restart_started = state.get('restart_started', 0.0)
+
     def on_config_changed(self, event):
+        self._apply_source_url_mode()
         self.configure_pod()
 
+    def _apply_source_url_mode(self):
+        """Rebuild the data sources if source_url_mode changed."""
+        mode = self.model.config['source_url_mode']
+        if not self.unit.is_leader() \
+                or mode not in VALID_SOURCE_URL_MODES \
+                or mode == self.datastore.source_url_mode:
+            return
+
+        log.info('Building data source URLs in {} mode.'.format(mode))
+        self.datastore.source_url_mode = mode
+        self._rebuild_datastore_from_relations()
+
     def on_update_status(self, event):
         """Various health checks of the charm."""
         self._check_high_availability()
+        self._acknowledge_restart()
+        # changed probe results or a change held back by a rollout that
+        # did not finish within restart_ack_timeout
+        if self.unit.is_leader() \
+                and (self._probe_sources() or self._rollout_pending()):
+            self.configure_pod()
         # TODO: add pod status check here
 
+    def on_leader_elected(self, event):
+        """Rebuild the charm's state from relation data and set the pod spec.
+
+        Data sources, database and redis config are only kept in the
+        StoredState of the leader, so a new leader would otherwise set a
+        pod spec without them until every relation changed again.
+        """
+        self._restore_shared_state()
+        # only the leader follows source_url_mode, so this unit's stored
+        # mode may be stale and would rename every source in the rebuild
+        mode = self.model.config['source_url_mode']
+        if mode in VALID_SOURCE_URL_MODES:
+            self.datastore.source_url_mode = mode
+        self._rebuild_datastore_from_relations()
+        self.configure_pod()
+
+    def on_collect_metrics(self, event):
+        """Report the size of the pod spec the leader set."""
+        if self.unit.is_leader():
+            event.add_metrics({'pod-spec-size': self.datastore.pod_spec_size})
+
     def on_start(self, event):
         # TODO:
         pass
 
+    def on_sqlite_maintenance_action(self, event):
+        """VACUUM and/or ANALYZE the single node sqlite3 database."""
+        if self.has_db:
+            event.fail('Grafana is using a related database, '
+                       'sqlite maintenance is not applicable.')
+            return
+
+        db_path = event.params.get('path') or os.path.join(
+            self.meta.storages['sqlitedb'].location, SQLITE_DATABASE_FILE)
+        try:
+            results = sqlite_maintenance(db_path,
+                                         vacuum=event.params['vacuum'],
+                                         analyze=event.params['analyze'])
+        except (OSError, sqlite3.Error) as e:
+            log.error('sqlite maintenance failed: {}'.format(e))
+            event.fail('sqlite maintenance failed: {}'.format(e))
+            return
+
+        log.info('sqlite maintenance of {} done: {}'.format(db_path, results))
+        event.set_results(results)
+
     def on_grafana_source_changed(self, event):
         """ Get relation data for Grafana source and set k8s pod spec.
 
@@ -155,70 +698,53 @@ class GrafanaK8s(CharmBase):
                 self.unit.name))
             return
 
+        # applications publishing all their data sources at once (v2)
+        # are applied as one batch, whichever unit triggered the event
+        try:
+            batch = self._get_batched_sources(event.relation)
+        except ValueError as e:
+            log.error('Ignoring invalid data sources of {}: {}'.format(
+                event.relation.app.name, e))
+            return
+        if batch is not None:
+            self._set_relation_sources(event.relation.id, batch)
+            self.configure_pod()
+            return
+
         # if there is no available unit, remove data-source info if it exists
         if event.unit is None:
-            self._remove_source_from_datastore(event.relation.id)
+            self._remove_relation_sources(event.relation.id)
             log.warning("event unit can't be None when setting data sources.")
+            self.configure_pod()
             return
 
-        # dictionary of all the required/optional datasource field values
-        # using this as a more generic way of getting data source fields
-        datasource_fields = \
-            {field: event.relation.data[event.unit].get(field) for field in
-             REQUIRED_DATASOURCE_FIELDS | OPTIONAL_DATASOURCE_FIELDS}
+        datasource_fields, missing_fields = \
+            self._get_source_fields(event.relation, event.unit)
 
-        missing_fields = [field for field
-                          in REQUIRED_DATASOURCE_FIELDS
-                          if datasource_fields.get(field) is None]
         # check the relation data for missing required fields
         if len(missing_fields) > 0:
             log.error("Missing required data fields for grafana-source "
                       "relation: {}".format(missing_fields))
-            self._remove_source_from_datastore(event.relation.id)
-            return
-
-        # specifically handle optional fields if necessary
-        if datasource_fields['source-name'] is None:
-            datasource_fields['source-name'] = event.unit.name
-            log.warning("No human readable name provided for 'grafana-source' "
-                        "relation. Defaulting to unit name.")
-
-        # check if this name already exists in the current datasources
-        # TODO: do we want to handle this or just throw an error?
-        #       we don't want to just block this unit, but I wonder if
-        #       an error will be handled properly
-        if datasource_fields['source-name'] in self.datastore.source_names:
-            log.error('name already taken by existing grafana-source')
+            self._remove_relation_sources(event.relation.id)
+            self.configure_pod()
             return
-        else:
-            self.datastore.source_names.add(datasource_fields['source-name'])
 
-        # set the first grafana-source as the default (needed for pod config)
-        # if `self.datastore.sources` is currently emtpy, this is the first
-        # TODO: confirm that this is what we want
-        if not dict(self.datastore.sources):
-            datasource_fields['isDefault'] = 'true'
-        else:
-            datasource_fields['isDefault'] = 'false'
-
-        # add unit name so the source can be removed might be a
-        # duplicate of 'source-name', but this will guarantee lookup
-        datasource_fields['unit_name'] = event.unit.name
-
-        # add the new datasource relation data to the current state
-        # make sure that we can handle multiple units of the same relation
-        # as well as different relations altogether
-        new_source_data = {
-            field: value for field, value in datasource_fields.items()
-            if value is not None
-        }
-        self.datastore.sources.update({event.relation.id: new_source_data})
-        self.configure_pod()
+        if self._set_source(source_key(event.relation.id), datasource_fields):
+            self.configure_pod()
 
     def on_grafana_source_departed(self, event):
-        """When a grafana-source is removed, delete from the datastore."""
+        """When a grafana-source is removed, delete from the datastore.
+
+        Data sources published as a batch or addressed by service are
+        kept while any unit of the source application is left.
+        """
         if self.unit.is_leader():
-            self._remove_source_from_datastore(event.relation.id)
+            app_data = {} if event.relation.app is None \
+                else event.relation.data[event.relation.app]
+            shared_by_units = BATCHED_DATASOURCES_KEY in app_data \
+                or self.datastore.source_url_mode == 'service'
+            if not event.relation.units or not shared_by_units:
+                self._remove_relation_sources(event.relation.id)
         self.configure_pod()
 
     def on_peer_changed(self, event):
@@ -227,7 +753,9 @@ class GrafanaK8s(CharmBase):
         #       work out of the box if we are OK with "Sticky Sessions"
         #       but having "Stateless Sessions" will require more config
 
-        # if the config changed, set a new pod spec
+        # let the leader know if this unit finished its restart, then
+        # set a new pod spec if the config changed or a restart was waiting
+        self._acknowledge_restart()
         self.configure_pod()
 
     def on_peer_departed(self, event):
@@ -248,31 +776,12 @@ class GrafanaK8s(CharmBase):
             log.warning("event unit can't be None when setting db config.")
             return
 
-        # save the necessary configuration of this database connection
-        database_fields = \
-            {field: event.relation.data[event.unit].get(field) for field in
-             REQUIRED_DATABASE_FIELDS | OPTIONAL_DATABASE_FIELDS}
-
-        # if any required fields are missing, warn the user and return
-        missing_fields = [field for field
-                          in REQUIRED_DATABASE_FIELDS
-                          if database_fields.get(field) is None]
-        if len(missing_fields) > 0:
-            log.error("Missing required data fields for related database "
-                      "relation: {}".format(missing_fields))
-            return
-
-        # check that the passed database type is not in VALID_DATABASE_TYPES
-        if database_fields['type'] not in VALID_DATABASE_TYPES:
-            log.error('Grafana can only accept databases of the following '
-                      'types: {}'.format(VALID_DATABASE_TYPES))
+        database_fields = self._get_database_fields(event.relation, event.unit)
+        if database_fields is None:
             return
 
         # add the new database relation data to the datastore
-        self.datastore.database.update({
-            field: value for field, value in database_fields.items()
-            if value is not None
-        })
+        self.datastore.database = pack_database(database_fields)
 
         # set pod spec with new database config data
         self.configure_pod()
@@ -291,22 +800,402 @@ class GrafanaK8s(CharmBase):
             return
 
         # remove the existing database info from datastore
-        self.datastore.database = dict()
+        self.datastore.database = list()
 
         # set pod spec because datastore config has changed
         self.configure_pod()
 
-    def _remove_source_from_datastore(self, rel_id):
-        log.info('Removing all data for relation: {}'.format(rel_id))
-        removed_source = self.datastore.sources.pop(rel_id, None)
-        if removed_source is None:
+    def on_redis_changed(self, event):
+        """Use a related redis as the Grafana Live HA engine."""
+        if not self.unit.is_leader():
+            log.debug('unit is not leader. '
+                      'Skipping on_redis_changed() handler')
+            return
+
+        if event.unit is None:
+            log.warning("event unit can't be None when setting redis config.")
+            return
+
+        redis_fields = self._get_redis_fields(event.relation, event.unit)
+        if redis_fields is None:
+            return
+
+        self.datastore.redis_address = '{}:{}'.format(
+            redis_fields['hostname'], redis_fields['port'])
+        self.datastore.redis_password = redis_fields.get('password', '')
+        self.configure_pod()
+
+    def on_redis_departed(self, event):
+        """Fall back to the in-memory Grafana Live engine."""
+        if not self.unit.is_leader():
+            log.debug('unit is not leader. '
+                      'Skipping on_redis_departed() handler')
+            return
+
+        self.datastore.redis_address = ''
+        self.datastore.redis_password = ''
+        self.configure_pod()
+
+    def _get_redis_fields(self, relation, unit):
+        """Get the redis config a unit set on the redis relation.
+
+        Returns None if the config is incomplete.
+        """
+        redis_fields = {field: relation.data[unit].get(field) for field in
+                        REQUIRED_REDIS_FIELDS | OPTIONAL_REDIS_FIELDS}
+        missing_fields = [field for field in REQUIRED_REDIS_FIELDS
+                          if redis_fields.get(field) is None]
+        if len(missing_fields) > 0:
+            log.error("Missing required data fields for related redis "
+                      "relation: {}".format(sorted(missing_fields)))
+            return None
+
+        return {field: value for field, value in redis_fields.items()
+                if value is not None}
+
+    def _get_source_fields(self, relation, unit):
+        """Get the data source fields a unit set on a grafana-source relation.
+
+        Returns the fields and a list of the missing required fields.
+        """
+        # dictionary of all the required/optional datasource field values
+        # using this as a more generic way of getting data source fields
+        datasource_fields = \
+            {field: relation.data[unit].get(field) for field in
+             REQUIRED_DATASOURCE_FIELDS | OPTIONAL_DATASOURCE_FIELDS}
+
+        missing_fields = [field for field
+                          in REQUIRED_DATASOURCE_FIELDS
+                          if datasource_fields.get(field) is None]
+
+        # specifically handle optional fields if necessary
+        by_service = self.datastore.source_url_mode == 'service'
+        if datasource_fields['source-name'] is None:
+            datasource_fields['source-name'] = \
+                relation.app.name if by_service else unit.name
+            log.warning("No human readable name provided for 'grafana-source' "
+                        "relation. Defaulting to {} name.".format(
+                            'application' if by_service else 'unit'))
+
+        # the same address for every unit, so the data source doesn't
+        # change (and restart Grafana) when the providing unit does
+        if by_service:
+            datasource_fields['private-address'] = \
+                self._get_service_address(relation, unit)
+
+        # add unit name so the source can be removed might be a
+        # duplicate of 'source-name', but this will guarantee lookup
+        # (a data source addressed by service belongs to the application)
+        datasource_fields['unit_name'] = \
+            relation.app.name if by_service else unit.name
+
+        return datasource_fields, missing_fields
+
+    def _get_batched_sources(self, relation):
+        """Get the data sources an application published as one batch.
+
+        Returns None if the application uses the per-unit protocol,
+        otherwise the complete data sources keyed by `source_key()`.
+        Incomplete entries are skipped, a list that can't be parsed
+        raises ValueError.
+        """
+        if relation.app is None \
+                or BATCHED_DATASOURCES_KEY not in relation.data[relation.app]:
+            return None
+
+        entries = json.loads(
+            relation.data[relation.app][BATCHED_DATASOURCES_KEY])
+        if not isinstance(entries, list) \
+                or not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError('expected a list of data sources')
+
+        batch = {}
+        for entry in entries:
+            datasource_fields = {
+                field: None if entry.get(field) is None else str(entry[field])
+                for field in REQUIRED_DATASOURCE_FIELDS | {'source-name'}}
+            missing_fields = [field for field, value
+                              in datasource_fields.items() if value is None]
+            if missing_fields:
+                log.error('Missing required data fields for data source {} '
+                          'of {}: {}'.format(entry, relation.app.name,
+                                             sorted(missing_fields)))
+                continue
+            datasource_fields['unit_name'] = relation.app.name
+            key = source_key(relation.id, datasource_fields['source-name'])
+            batch[key] = datasource_fields
+        return batch
+
+    def _set_relation_sources(self, rel_id, batch):
+        """Apply a batch of data sources to the datastore.
+
+        Sources of the relation that are not in the batch are removed,
+        the others are added or updated (bumping only changed versions).
+        """
+        for key in set(self._get_relation_source_keys(rel_id)) - set(batch):
+            self._remove_source_from_datastore(key)
+        for key in sorted(batch):
+            self._set_source(key, batch[key])
+        log.debug('Applied {} data sources of relation {}.'.format(
+            len(batch), rel_id))
+
+    def _probe_sources(self) -> bool:
+        """Probe the data sources whose cached probe result expired.
+
+        Returns True if a data source became reachable or unreachable.
+        """
+        config = self.model.config
+        if config['datasource_validation'] not in ('mark', 'hold'):
+            return False
+
+        endpoints = {
+            '{}:{}'.format(source['private-address'], source['port']):
+                (source['private-address'], source['port'])
+            for source in self.sources.values()}
+        cache = self.datastore.probe_results
+        for key in set(cache) - set(endpoints):
+            del cache[key]
+
+        now = time.time()
+        expired = now - config['datasource_probe_ttl']
+        stale = [endpoint for key, endpoint in endpoints.items()
+                 if cache.get(key, [None, expired])[1] <= expired]
+        changed = False
+        results = probe_endpoints(stale, config['datasource_probe_timeout'])
+        for (address, port), reachable in results.items():
+            key = '{}:{}'.format(address, port)
+            if not reachable:
+                log.warning('Data source at {} is unreachable.'.format(key))
+            changed |= cache.get(key, [True])[0] != reachable
+            cache[key] = [reachable, now]
+        return changed
+
+    def _get_unreachable_sources(self) -> list:
+        """Get the names of the data sources that failed their probe."""
+        if self.model.config['datasource_validation'] not in ('mark', 'hold'):
+            return []
+
+        cache = self.datastore.probe_results
+        return [source['source-name'] for source in self._sorted_sources()
+                if not cache.get('{}:{}'.format(source['private-address'],
+                                                source['port']), [True])[0]]
+
+    def _get_service_address(self, relation, unit):
+        """Get the load balanced address of a grafana-source application.
+
+        This is the 'service-address' field of the unit or application
+        databag, otherwise the cluster DNS name of the application's
+        Kubernetes service (which Juju names after the application).
+        """
+        for entity in (unit, relation.app):
+            if entity is not None \
+                    and relation.data[entity].get(SERVICE_ADDRESS_FIELD):
+                return relation.data[entity][SERVICE_ADDRESS_FIELD]
+        return '{}.{}.svc'.format(relation.app.name, self.model.name)
+
+    def _set_source(self, key, datasource_fields) -> bool:
+        """Add or update a data source, see `source_key()`.
+
+        Returns False if the source name is already taken by another source.
+        """
+        # check if this name already exists in the current datasources
+        # TODO: do we want to handle this or just throw an error?
+        #       we don't want to just block this unit, but I wonder if
+        #       an error will be handled properly
+        # a re-delivered event for the same source is not a duplicate
+        current_source = self._get_source(key)
+        current_name = None if current_source is None \
+            else current_source['source-name']
+        if datasource_fields['source-name'] != current_name:
+            if datasource_fields['source-name'] in self.datastore.source_names:
+                log.error('name already taken by existing grafana-source')
+                return False
+            keep_default = current_name is not None \
+                and current_name == self.datastore.default_source
+            if current_source is not None:
+                self._remove_source_from_datastore(key)
+            self.datastore.source_names.add(datasource_fields['source-name'])
+            # the first source becomes the default one, it stays the
+            # default (even if renamed) until it is removed
+            if keep_default or not self.datastore.default_source:
+                self.datastore.default_source = \
+                    datasource_fields['source-name']
+
+        # add the new datasource relation data to the current state
+        # make sure that we can handle multiple units of the same relation
+        # as well as different relations altogether
+        new_source_data = {
+            field: value for field, value in datasource_fields.items()
+            if value is not None
+        }
+
+        # the version is bumped once the changed entry is rendered,
+        # see `_update_source_versions()`
+        name = new_source_data['source-name']
+        new_source_data['version'] = self.datastore.source_versions.get(name, 0)
+
+        # a re-added source must not be deleted again by its old tombstone
+        self.datastore.tombstones.pop(name, None)
+
+        self.datastore.sources[key] = pack_source(new_source_data)
+        return True
+
+    def _get_database_fields(self, relation, unit):
+        """Get the database config a unit set on the database relation.
+
+        Returns None if the config is incomplete or invalid.
+        """
+        # save the necessary configuration of this database connection
+        database_fields = \
+            {field: relation.data[unit].get(field) for field in
+             REQUIRED_DATABASE_FIELDS | OPTIONAL_DATABASE_FIELDS}
+
+        # if any required fields are missing, warn the user and return
+        missing_fields = [field for field
+                          in REQUIRED_DATABASE_FIELDS
+                          if database_fields.get(field) is None]
+        if len(missing_fields) > 0:
+            log.error("Missing required data fields for related database "
+                      "relation: {}".format(missing_fields))
+            return None
+
+        # check that the passed database type is not in VALID_DATABASE_TYPES
+        if database_fields['type'] not in VALID_DATABASE_TYPES:
+            log.error('Grafana can only accept databases of the following '
+                      'types: {}'.format(VALID_DATABASE_TYPES))
+            return None
+
+        return {field: value for field, value in database_fields.items()
+                if value is not None}
+
+    def _rebuild_datastore_from_relations(self):
+        """Rebuild sources, database and redis config from relation data.
+
+        This is a single pass over the grafana-source, database and redis
+        relations. Sources that are unchanged keep their version, so a
+        rebuild without actual changes does not restart the pods.
+        """
+        start = time.monotonic()
+
+        # find the data source of every grafana-source relation, preferring
+        # the unit that provided it before and otherwise the first complete
+        live_sources = {}
+        unreadable = set()
+        for relation in sorted(self.model.relations['grafana-source'],
+                               key=lambda rel: rel.id):
+            # batches replace the per-unit data, invalid ones are kept as is
+            try:
+                batch = self._get_batched_sources(relation)
+            except ValueError as e:
+                log.error('Keeping data sources of {}, the new ones are '
+                          'invalid: {}'.format(relation.app.name, e))
+                unreadable.update(self._get_relation_source_keys(relation.id))
+                continue
+            if batch is not None:
+                live_sources.update(batch)
+                continue
+
+            current_source = self._get_source(relation.id) or {}
+            units = sorted(relation.units, key=lambda unit: (
+                unit.name != current_source.get('unit_name'), unit.name))
+            for unit in units:
+                datasource_fields, missing_fields = \
+                    self._get_source_fields(relation, unit)
+                if not missing_fields:
+                    live_sources[relation.id] = datasource_fields
+                    break
+
+        # first free the names of sources that are gone, then set the others
+        for key in set(self.datastore.sources) - set(live_sources) \
+                - unreadable:
+            self._remove_source_from_datastore(key)
+        for key, datasource_fields in live_sources.items():
+            self._set_source(key, datasource_fields)
+
+        database = {}
+        for relation in self.model.relations['database']:
+            for unit in sorted(relation.units, key=lambda unit: unit.name):
+                database = self._get_database_fields(relation, unit) or {}
+                if database:
+                    break
+        self.datastore.database = pack_database(database)
+
+        redis = {}
+        for relation in self.model.relations['redis']:
+            for unit in sorted(relation.units, key=lambda unit: unit.name):
+                redis = self._get_redis_fields(relation, unit) or {}
+                if redis:
+                    break
+        self.datastore.redis_address = '{}:{}'.format(
+            redis['hostname'], redis['port']) if redis else ''
+        self.datastore.redis_password = redis.get('password', '')
+
+        log.info('Rebuilt {} data sources from relation data in {:.3f}s.'
+                 .format(len(self.datastore.sources), time.monotonic() - start))
+
+    def _get_relation_source_keys(self, rel_id):
+        """Get the datastore keys of all data sources of a relation."""
+        prefix = '{}/'.format(rel_id)
+        return [key for key in self.datastore.sources
+                if key == rel_id or str(key).startswith(prefix)]
+
+    def _remove_relation_sources(self, rel_id):
+        """Remove all data sources of a relation from the datastore."""
+        keys = self._get_relation_source_keys(rel_id)
+        if not keys:
             log.warning('Could not remove source for relation: {}'.format(
                 rel_id))
+        for key in keys:
+            self._remove_source_from_datastore(key)
+
+    def _remove_source_from_datastore(self, key):
+        log.info('Removing data source: {}'.format(key))
+        removed_source = self._get_source(key)
+        if removed_source is None:
+            log.warning('Could not remove data source: {}'.format(key))
         else:
-            # free name from charm's set of source names
-            # and save to set which will be used in set_pod_spec
+            # free name from charm's set of source names and keep a
+            # tombstone until every replica has applied the deletion
+            del self.datastore.sources[key]
             self.datastore.source_names.remove(removed_source['source-name'])
-            self.datastore.sources_to_delete.add(removed_source['source-name'])
+            self.datastore.tombstones[removed_source['source-name']] = 0
+            self.datastore.source_hashes.pop(
+                removed_source['source-name'], None)
+            if removed_source['source-name'] == self.datastore.default_source:
+                self.datastore.default_source = min(
+                    self.datastore.source_names, default='')
+
+    def _acknowledged_generation(self) -> int:
+        """Get the newest restart generation every replica has applied.
+
+        Without peers the leader's own pod is the only one, so every
+        generation that was set in the pod spec counts as applied.
+        """
+        rel = self.model.get_relation('grafana')
+        if rel is None or not rel.units:
+            return self.datastore.restart_generation
+
+        acks = [int(rel.data[unit][RESTART_ACK_KEY])
+                for unit in rel.units | {self.unit}
+                if RESTART_ACK_KEY in rel.data[unit]]
+        return min(acks, default=0)
+
+    def _compact_tombstones(self) -> bool:
+        """Drop tombstones whose deletion every replica has applied.
+
+        No replica knows these sources anymore, so their versions are
+        dropped too and a re-added source starts again at version 1.
+        Returns True if any tombstones were removed.
+        """
+        acknowledged = self._acknowledged_generation()
+        applied = [name for name, generation
+                   in self.datastore.tombstones.items()
+                   if 0 < generation <= acknowledged]
+        for name in applied:
+            log.debug('Compacting tombstone of data source {}'.format(name))
+            del self.datastore.tombstones[name]
+            self.datastore.source_versions.pop(name, None)
+        return len(applied) > 0
 
     def _check_high_availability(self):
         """Checks whether the configuration allows for HA."""
@@ -314,6 +1203,10 @@ class GrafanaK8s(CharmBase):
             if self.has_db:
                 log.info('high availability possible.')
                 status = HA_READY_STATUS
+                if not self.has_redis:
+                    log.warning('Grafana Live messages only reach clients '
+                                'of the same replica without a redis '
+                                'relation.')
             else:
                 log.warning('high availability not possible '
                             'with current configuration.')
@@ -335,6 +1228,135 @@ class GrafanaK8s(CharmBase):
 
         return status
 
+    def _grafana_request(self, path):
+        """Get a page of Grafana of this unit, or None if it doesn't answer."""
+        try:
+            address = self.model.get_binding('grafana').network.ingress_address
+        except ModelError as e:
+            log.debug('Unable to get address of this unit: {}'.format(e))
+            return None
+
+        context = None
+        scheme = 'http'
+        if self.uses_tls:
+            # only liveness matters here, the certificate may be self-signed
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            scheme = 'https'
+        url = '{}://{}:{}{}'.format(
+            scheme, address, self.model.config['advertised_port'], path)
+        try:
+            with urllib.request.urlopen(url, timeout=HEALTH_CHECK_TIMEOUT,
+                                        context=context) as response:
+                return response.read().decode()
+        except (OSError, http.client.HTTPException, UnicodeError) as e:
+            log.debug('Requesting {} failed: {}'.format(url, e))
+            return None
+
+    def _grafana_is_healthy(self) -> bool:
+        """Check whether Grafana of this unit answers on /api/health."""
+        return self._grafana_request('/api/health') is not None
+
+    def _grafana_process_start_time(self):
+        """Get the unix time the Grafana process of this unit started at.
+
+        This is `process_start_time_seconds` of Grafana's /metrics, None if
+        it is not available.
+        """
+        metrics = self._grafana_request('/metrics')
+        for line in (metrics or '').splitlines():
+            name, _, value = line.partition(' ')
+            if name == 'process_start_time_seconds':
+                try:
+                    return float(value)
+                except ValueError:
+                    break
+        return None
+
+    def _acknowledge_restart(self):
+        """Acknowledge the current restart generation once Grafana runs it.
+
+        A healthy Grafana is not enough, the pod of this unit may not have
+        been replaced yet. Only a Grafana process started after the leader
+        set the pod spec of the generation runs its config. Units with a
+        clock far behind the leader's may not acknowledge at all, the
+        leader continues after `restart_ack_timeout` then.
+        """
+        rel = self.model.get_relation('grafana')
+        if rel is None:
+            return
+
+        state = self._shared_state()
+        generation = state.get('restart_generation')
+        if generation is None:
+            return
+        generation = str(generation)
+        if rel.data[self.unit].get(RESTART_ACK_KEY) == generation:
+            return
+
+        if not self._grafana_is_healthy():
+            return
+        start_time = self._grafana_process_start_time()
+        if start_time is None \
+                or start_time < state.get('restart_started', 0):
+            log.debug('Grafana has not restarted for generation {} yet.'
+                      .format(generation))
+            return
+
+        log.info('Acknowledging restart generation {}.'.format(generation))
+        rel.data[self.unit][RESTART_ACK_KEY] = generation
+
+    def _units_restarting(self) -> list:
+        """Get the names of units that have not finished the current restart.
+
+        Units that never acknowledged a generation are not counted, they are
+        not serving (yet) so restarting them does not reduce capacity.
+        """
+        rel = self.model.get_relation('grafana')
+        if rel is None:
+            return []
+
+        generation = str(self.datastore.restart_generation)
+        return [unit.name for unit in rel.units | {self.unit}
+                if rel.data[unit].get(RESTART_ACK_KEY) not in (None, generation)]
+
+    def _restart_allowed(self) -> bool:
+        """Check whether a new rollout of the Grafana pods may start.
+
+        Only one rollout happens at a time so the HA replicas keep serving.
+        Changes that arrive during a rollout are batched into the next one.
+        """
+        if not self.has_peer:
+            return True
+
+        restarting = self._units_restarting()
+        if not restarting:
+            return True
+
+        elapsed = time.time() - self.datastore.restart_started
+        if elapsed > self.model.config['restart_ack_timeout']:
+            log.warning('Units {} did not acknowledge restart generation {} '
+                        'within {}s. Continuing with the next restart.'.format(
+                            restarting, self.datastore.restart_generation,
+                            self.model.config['restart_ack_timeout']))
+            return True
+
+        log.info('Waiting for units {} to acknowledge restart generation {}.'
+                 .format(restarting, self.datastore.restart_generation))
+        return False
+
+    def _rollout_pending(self) -> bool:
+        """Check whether config changes are waiting to be rolled out."""
+        _, config_hashes = self._build_pod_spec_with_files()
+        return config_hashes != dict(self.datastore.config_hashes)
+
+    def _start_restart_generation(self, config_hashes):
+        """Record new config hashes and start the next restart generation."""
+        self.datastore.config_hashes = dict(config_hashes)
+        self.datastore.restart_generation += 1
+        self.datastore.restart_started = time.time()
+
     def _check_config(self):
         """Get list of missing charm settings."""
         config = self.model.config
@@ -347,6 +1369,53 @@ class GrafanaK8s(CharmBase):
                 and not config['grafana_image_password']:
             missing.append('grafana_image_password')
 
+        # probe timings are in (whole) seconds and need to be positive
+        for probe in ('startup', 'readiness', 'liveness'):
+            for setting in ('period', 'timeout', 'failure_threshold'):
+                option = '{}_probe_{}'.format(probe, setting)
+                if config[option] < 1:
+                    missing.append(option)
+
+        if config['sqlite_performance_mode'] \
+                and config['sqlite_cache_mode'] \
+                not in VALID_SQLITE_CACHE_MODES:
+            missing.append('sqlite_cache_mode')
+
+        missing.extend(self._check_log_config())
+
+        if config['source_url_mode'] not in VALID_SOURCE_URL_MODES:
+            missing.append('source_url_mode')
+
+        if config['server_protocol'] not in VALID_SERVER_PROTOCOLS:
+            missing.append('server_protocol')
+        elif self.uses_tls:
+            missing.extend(option for option in ('tls_cert', 'tls_key')
+                           if not config[option].strip())
+
+        if config['server_read_timeout'] < 0:
+            missing.append('server_read_timeout')
+
+        if config['live_max_connections'] < 0:
+            missing.append('live_max_connections')
+
+        if config['datasource_validation'] \
+                not in VALID_DATASOURCE_VALIDATION_MODES:
+            missing.append('datasource_validation')
+        if config['datasource_probe_timeout'] < 1:
+            missing.append('datasource_probe_timeout')
+        if config['datasource_probe_ttl'] < 0:
+            missing.append('datasource_probe_ttl')
+
+        if config['query_cache_enabled']:
+            if not config['query_cache_image']:
+                missing.append('query_cache_image')
+            if not 0 < config['query_cache_port'] < 65536 \
+                    or config['query_cache_port'] == config['advertised_port']:
+                missing.append('query_cache_port')
+            for option in ('query_cache_size', 'query_cache_ttl'):
+                if config[option] < 1:
+                    missing.append(option)
+
         # TODO: does it make sense to set state directly in this method?
         if missing:
             self.unit.status = \
@@ -354,58 +1423,210 @@ class GrafanaK8s(CharmBase):
 
         return missing
 
+    def _check_log_config(self):
+        """Get list of invalid logging settings."""
+        config = self.model.config
+        invalid = []
+
+        modes = config['grafana_log_mode'].split()
+        if not modes or not set(modes) <= VALID_LOG_MODES:
+            invalid.append('grafana_log_mode')
+        if config['grafana_log_level'] not in VALID_LOG_LEVELS:
+            invalid.append('grafana_log_level')
+
+        # filters look like "<logger>:<level> <logger>:<level> ..."
+        for log_filter in config['grafana_log_filters'].split():
+            logger, _, level = log_filter.partition(':')
+            if not logger or level not in VALID_LOG_LEVELS:
+                invalid.append('grafana_log_filters')
+                break
+
+        for option in ('log_file_max_lines', 'log_file_max_size_shift',
+                       'log_file_max_days'):
+            if config[option] < 1:
+                invalid.append(option)
+
+        if config['log_console_format'] not in VALID_LOG_CONSOLE_FORMATS:
+            invalid.append('log_console_format')
+        return invalid
+
     def _make_delete_datasources_config_text(self) -> str:
-        """Generate text of data sources to delete."""
-        if not self.datastore.sources_to_delete:
+        """Generate text of data sources to delete.
+
+        Tombstones stay in the file until all replicas applied them (see
+        `_compact_tombstones()`), deleting an unknown source is a no-op.
+        """
+        if not self.datastore.tombstones:
             return "\n"
 
         delete_datasources_text = textwrap.dedent("""
         deleteDatasources:""")
-        for name in self.datastore.sources_to_delete:
+        for name in sorted(self.datastore.tombstones):
             delete_datasources_text += textwrap.dedent("""
             - name: {}
               orgId: 1""".format(name))
 
-        # clear datastore.sources_to_delete and return text result
-        self.datastore.sources_to_delete.clear()
         return delete_datasources_text + '\n\n'
 
+    def _sorted_sources(self) -> list:
+        """Get the data sources in a canonical order (by source name).
+
+        The order of `datastore.sources` depends on the order in which
+        relations arrived, so rendering it directly could change the file
+        hash (and restart the pods) without an actual config change.
+        """
+        return sorted(self.sources.values(),
+                      key=lambda source_info: source_info['source-name'])
+
+    def _provisioned_sources(self) -> list:
+        """Get the data sources to provision, the default one first.
+
+        The order only depends on the stored state, not on the order of
+        the events that added the sources: the default source (Grafana
+        needs exactly one) comes first, the rest by name. Unreachable
+        sources are held back with datasource_validation=hold, a held
+        default is replaced by the next source while it is held.
+        """
+        sources = self._sorted_sources()
+        if self.model.config['datasource_validation'] == 'hold':
+            held = set(self._get_unreachable_sources())
+            sources = [source_info for source_info in sources
+                       if source_info['source-name'] not in held]
+        sources.sort(key=lambda source_info: (
+            source_info['source-name'] != self.datastore.default_source))
+        return sources
+
+    def _make_data_source_entry(self, source_info, is_default, version) -> str:
+        """Render the datasources.yaml entry of a single data source."""
+        # TODO: handle more optional fields and verify that current
+        #       defaults are what we want (e.g. "access")
+        return DATASOURCE_TEMPLATE.format(
+            source_info['source-name'],
+            source_info['source-type'],
+            self._get_source_url(source_info),
+            'true' if is_default else 'false',
+            version,
+            self.model.config['basic_auth_username'],
+            self.model.config['basic_auth_password'],
+        )
+
+    def _update_source_versions(self):
+        """Bump the version of every data source whose entry changed.
+
+        Grafana only updates a provisioned data source if its version
+        increased. Besides the relation data, the entry depends on which
+        source is the default, the URL (source_url_mode, query cache) and
+        the basic auth config, so the rendered entry without its version
+        is compared to the one the current version was set for.
+        https://grafana.com/docs/grafana/latest/administration/provisioning/#running-multiple-grafana-instances
+        """
+        for index, source_info in enumerate(self._provisioned_sources()):
+            name = source_info['source-name']
+            entry_hash = hashlib.md5(self._make_data_source_entry(
+                source_info, index == 0, '').encode()).hexdigest()
+            if self.datastore.source_hashes.get(name) != entry_hash:
+                self.datastore.source_hashes[name] = entry_hash
+                self.datastore.source_versions[name] = \
+                    self.datastore.source_versions.get(name, 0) + 1
+
+        for key, source_info in self.sources.items():
+            version = self.datastore.source_versions.get(
+                source_info['source-name'], 0)
+            if source_info['version'] != version:
+                self.datastore.sources[key] = pack_source(
+                    dict(source_info, version=version))
+
     def _make_data_source_config_text(self) -> str:
-        """Build config based on Data Sources section of provisioning docs."""
+        """Build config based on Data Sources section of provisioning docs.
+
+        See `_provisioned_sources()` for the order of the data sources.
+        """
+        sources = self._provisioned_sources()
+
         # get starting text for the config file and sources to delete
         delete_text = self._make_delete_datasources_config_text()
         config_text = textwrap.dedent("""
         apiVersion: 1
         """)
         config_text += delete_text
-        if self.datastore.sources:
+        if sources:
             config_text += "datasources:"
-        for rel_id, source_info in self.datastore.sources.items():
-            # TODO: handle more optional fields and verify that current
-            #       defaults are what we want (e.g. "access")
-            config_text += textwrap.dedent("""
-                - name: {0}
-                  type: {1}
-                  access: proxy
-                  url: http://{2}:{3}
-                  isDefault: {4}
-                  editable: true
-                  orgId: 1
-                  basicAuthUser: {5}
-                  secureJsonData:
-                    basicAuthPassword: {6}""").format(
-                source_info['source-name'],
-                source_info['source-type'],
-                source_info['private-address'],
-                source_info['port'],
-                source_info['isDefault'],
-                self.model.config['basic_auth_username'],
-                self.model.config['basic_auth_password'],
-            )
+        config_text += ''.join(
+            self._make_data_source_entry(
+                source_info, index == 0, source_info['version'])
+            for index, source_info in enumerate(sources))
 
         # check if there these are empty
         return config_text + '\n'
 
+    def _get_source_url(self, source_info) -> str:
+        """Get the URL Grafana queries a data source at.
+
+        With the query cache enabled, Prometheus data sources are queried
+        through the sidecar, which forwards to the data source by name.
+        """
+        if self._uses_query_cache(source_info):
+            return 'http://localhost:{}/{}'.format(
+                self.model.config['query_cache_port'],
+                urllib.parse.quote(source_info['source-name'], safe=''))
+        return 'http://{}:{}'.format(source_info['private-address'],
+                                     source_info['port'])
+
+    def _uses_query_cache(self, source_info) -> bool:
+        return self.model.config['query_cache_enabled'] \
+            and source_info['source-type'] in QUERY_CACHE_SOURCE_TYPES
+
+    def _make_query_cache_config_text(self) -> str:
+        """Create the config file of the query cache sidecar."""
+        config = self.model.config
+        upstreams = {
+            source_info['source-name']: 'http://{}:{}'.format(
+                source_info['private-address'], source_info['port'])
+            for source_info in self.sources.values()
+            if self._uses_query_cache(source_info)}
+        return json.dumps({
+            'port': config['query_cache_port'],
+            'max_bytes': config['query_cache_size'] * 1024 * 1024,
+            'ttl': config['query_cache_ttl'],
+            'upstreams': upstreams,
+        }, indent=2, sort_keys=True) + '\n'
+
+    def _update_pod_query_cache_sidecar(self, pod_spec):
+        """Adds the query cache sidecar to the pod, if it is enabled.
+
+        The proxy script is shipped with the charm and mounted next to its
+        config, so the sidecar only needs a stock Python image.
+        """
+        config = self.model.config
+        if not config['query_cache_enabled']:
+            return
+
+        with open(QUERY_CACHE_SCRIPT) as f:
+            script_text = f.read()
+        config_text = self._make_query_cache_config_text()
+        pod_spec['containers'].append({
+            'name': QUERY_CACHE_CONTAINER,
+            'imageDetails': {'imagePath': config['query_cache_image']},
+            'command': [
+                'python3',
+                os.path.join(QUERY_CACHE_MOUNT_PATH, 'query_cache.py'),
+                os.path.join(QUERY_CACHE_MOUNT_PATH, 'config.json'),
+            ],
+            # no ports: Grafana reaches the sidecar on localhost only
+            'files': [{
+                'name': 'grafana-query-cache',
+                'mountPath': QUERY_CACHE_MOUNT_PATH,
+                'files': {
+                    'query_cache.py': script_text,
+                    'config.json': config_text,
+                },
+            }],
+            'config': {
+                'QUERY_CACHE_CONFIG': hashlib.md5(
+                    (script_text + config_text).encode()).hexdigest(),
+            },
+        })
+
     def _update_pod_data_source_config_file(self, pod_spec):
         """Adds datasources to pod configuration."""
         file_text = self._make_data_source_config_text()
@@ -440,25 +1661,22 @@ class GrafanaK8s(CharmBase):
         config_text = textwrap.dedent("""
         [paths]
         provisioning = {0}
-
+        {3}
         [security]
         admin_user = {1}
         admin_password = {2}
-
-        [log]
-        mode = {3}
-        level = {4}
-        """.format(
+        """).format(
             self.model.config['provisioning_path'],
             self.model.config['basic_auth_username'],
             self.model.config['basic_auth_password'],
-            self.model.config['grafana_log_mode'],
-            self.model.config['grafana_log_level'],
-        ))
+            self._make_server_config_text(),
+        )
+        config_text += self._make_log_config_text()
+        config_text += self._make_live_config_text()
 
         # if there is a database available, add that information
         if self.datastore.database:
-            db_config = self.datastore.database
+            db_config = self.database
             config_text += textwrap.dedent("""
             [database]
             type = {0}
@@ -473,8 +1691,121 @@ class GrafanaK8s(CharmBase):
                 db_config['user'],
                 db_config['password'],
             ))
+
+        # otherwise Grafana falls back to sqlite3 on the `sqlitedb` storage,
+        # which can be tuned for many concurrent dashboard writes
+        elif self.model.config['sqlite_performance_mode']:
+            config_text += self._make_sqlite_config_text()
         return config_text
 
+    def _make_log_config_text(self):
+        """Create the [log] sections.
+
+        File logs are rotated so they can't fill the container filesystem,
+        console logs can be JSON for cluster log shippers.
+        """
+        config = self.model.config
+        modes = config['grafana_log_mode'].split()
+        log_text = textwrap.dedent("""
+        [log]
+        mode = {0}
+        level = {1}
+        """).format(config['grafana_log_mode'], config['grafana_log_level'])
+        if config['grafana_log_filters'].strip():
+            log_text += 'filters = {}\n'.format(
+                ' '.join(config['grafana_log_filters'].split()))
+
+        if 'file' in modes:
+            log_text += textwrap.dedent("""
+            [log.file]
+            log_rotate = true
+            max_lines = {0}
+            max_size_shift = {1}
+            daily_rotate = {2}
+            max_days = {3}
+            """).format(
+                config['log_file_max_lines'],
+                config['log_file_max_size_shift'],
+                str(config['log_file_daily_rotate']).lower(),
+                config['log_file_max_days'],
+            )
+
+        if 'console' in modes:
+            log_text += textwrap.dedent("""
+            [log.console]
+            format = {}
+            """).format(config['log_console_format'])
+        return log_text
+
+    def _make_live_config_text(self):
+        """Create the [live] section.
+
+        Live streams are websocket connections held by one replica, a
+        redis HA engine passes their messages on to the other replicas.
+        """
+        live_text = textwrap.dedent("""
+        [live]
+        max_connections = {}
+        """).format(self.model.config['live_max_connections'])
+
+        if self.datastore.redis_address:
+            live_text += 'ha_engine = redis\nha_engine_address = {}\n'.format(
+                self.datastore.redis_address)
+            if self.datastore.redis_password:
+                live_text += 'ha_engine_password = {}\n'.format(
+                    self.datastore.redis_password)
+        return live_text
+
+    def _make_server_config_text(self):
+        """Create the [server] section from the HTTP serving options.
+
+        Gzip trades some CPU for much smaller dashboard and query
+        responses and HTTP/2 multiplexes the many parallel panel queries
+        of a dashboard over a single connection.
+        """
+        config = self.model.config
+        server_text = textwrap.dedent("""
+        [server]
+        protocol = {0}
+        http_port = {1}
+        enable_gzip = {2}
+        router_logging = {3}
+        read_timeout = {4}s
+        """).format(
+            config['server_protocol'],
+            config['advertised_port'],
+            str(config['server_enable_gzip']).lower(),
+            str(config['server_router_logging']).lower(),
+            config['server_read_timeout'],
+        )
+        if self.uses_tls:
+            server_text += 'cert_file = {}\ncert_key = {}\n'.format(
+                os.path.join(TLS_MOUNT_PATH, TLS_CERT_FILE),
+                os.path.join(TLS_KEY_MOUNT_PATH, TLS_KEY_FILE))
+        return server_text
+
+    def _make_sqlite_config_text(self):
+        """Create the [database] section for the single node sqlite3 database.
+
+        WAL mode lets readers continue while a dashboard is being saved,
+        a shared cache reduces lock contention between connections and
+        Grafana retries queries and transactions on a locked database
+        instead of failing them immediately.
+        """
+        config = self.model.config
+        return textwrap.dedent("""
+        [database]
+        type = sqlite3
+        path = {0}
+        cache_mode = {1}
+        wal = true
+        query_retries = {2}
+        transaction_retries = {2}""".format(
+            SQLITE_DATABASE_FILE,
+            config['sqlite_cache_mode'],
+            config['sqlite_lock_retries'],
+        ))
+
     def _update_pod_config_ini_file(self, pod_spec):
         file_text = self._make_config_ini_text()
         config_ini_file_meta = {
@@ -495,6 +1826,80 @@ class GrafanaK8s(CharmBase):
             log.info('grafana.ini hash has changed. Triggering pod restart.')
         container['config']['GRAFANA_INI'] = file_text_hash
 
+    @property
+    def tls_secret_name(self) -> str:
+        """Name of the Kubernetes Secret holding the TLS private key."""
+        return '{}-tls'.format(self.app.name)
+
+    def _update_pod_tls_files(self, pod_spec):
+        """Adds the TLS certificate and key to pod configuration.
+
+        The key is mounted from the Secret of `_build_k8s_resources()`.
+        """
+        if not self.uses_tls:
+            return
+
+        config = self.model.config
+        tls_file_meta = {
+            'name': 'grafana-tls',
+            'mountPath': TLS_MOUNT_PATH,
+            'files': {
+                TLS_CERT_FILE: config['tls_cert'],
+            }
+        }
+        tls_key_meta = {
+            'name': 'grafana-tls-key',
+            'mountPath': TLS_KEY_MOUNT_PATH,
+            'secret': {
+                'name': self.tls_secret_name,
+                'files': [{'key': TLS_KEY_FILE, 'path': TLS_KEY_FILE}],
+            }
+        }
+        container = get_container(pod_spec, self.app.name)
+        container['files'].extend((tls_file_meta, tls_key_meta))
+
+        # Grafana only reads the certificate at start-up
+        tls_hash = hashlib.md5(
+            (config['tls_cert'] + config['tls_key']).encode()).hexdigest()
+        if 'GRAFANA_TLS' in container['config'] \
+                and container['config']['GRAFANA_TLS'] != tls_hash:
+            log.info('TLS material has changed. Triggering pod restart.')
+        container['config']['GRAFANA_TLS'] = tls_hash
+
+    def _build_k8s_resources(self):
+        """Build the Kubernetes resources set together with the pod spec.
+
+        Returns None if there are none.
+        """
+        if not self.uses_tls:
+            return None
+
+        return {
+            'kubernetesResources': {
+                'secrets': [{
+                    'name': self.tls_secret_name,
+                    'type': 'Opaque',
+                    'stringData': {
+                        TLS_KEY_FILE: self.model.config['tls_key'],
+                    },
+                }],
+            },
+        }
+
+    def _build_probe(self, period, timeout, failure_threshold):
+        """Build a Kubernetes probe of Grafana's /api/health endpoint."""
+        return {
+            'httpGet': {
+                'path': '/api/health',
+                'port': self.model.config['advertised_port'],
+                'scheme': 'HTTPS' if self.uses_tls else 'HTTP',
+            },
+            'initialDelaySeconds': 0,
+            'periodSeconds': period,
+            'timeoutSeconds': timeout,
+            'failureThreshold': failure_threshold,
+        }
+
     def _build_pod_spec(self):
         """Builds the pod spec based on available info in datastore`."""
 
@@ -519,15 +1924,21 @@ class GrafanaK8s(CharmBase):
                     'containerPort': config['advertised_port'],
                     'protocol': 'TCP'
                 }],
-                'readinessProbe': {
-                    'httpGet': {
-                        'path': '/api/health',
-                        'port': config['advertised_port']
-                    },
-                    # TODO: should these be in the config?
-                    'initialDelaySeconds': 10,
-                    'timeoutSeconds': 30
-                },
+                # the startup probe holds off the other probes until Grafana
+                # is up, so the pod is ready as soon as /api/health passes
+                'startupProbe': self._build_probe(
+                    config['startup_probe_period'],
+                    config['startup_probe_timeout'],
+                    config['startup_probe_failure_threshold']),
+                'readinessProbe': self._build_probe(
+                    config['readiness_probe_period'],
+                    config['readiness_probe_timeout'],
+                    config['readiness_probe_failure_threshold']),
+                # restarts a hung Grafana
+                'livenessProbe': self._build_probe(
+                    config['liveness_probe_period'],
+                    config['liveness_probe_timeout'],
+                    config['liveness_probe_failure_threshold']),
                 'files': [],
                 'config': {},  # used to store hashes of config file text
             }]
@@ -535,6 +1946,41 @@ class GrafanaK8s(CharmBase):
 
         return spec
 
+    def _check_pod_spec_size(self, pod_spec) -> bool:
+        """Check that the pod spec fits in `pod_spec_size_budget`.
+
+        Blocks the unit if it does not, as Juju would fail to set it.
+        """
+        budget = min(self.model.config['pod_spec_size_budget'],
+                     CONFIGMAP_SIZE_LIMIT)
+        total, file_sizes = pod_spec_size(pod_spec)
+        log.debug('Pod spec size is {} bytes, files: {}'.format(
+            total, file_sizes))
+
+        if total > budget:
+            log.error('Pod spec size of {} bytes exceeds the budget of {} '
+                      'bytes, files: {}'.format(total, budget, file_sizes))
+            self.unit.status = BlockedStatus(
+                'Pod spec too large: {} of {} bytes.'.format(total, budget))
+            return False
+
+        if total > budget * POD_SPEC_SIZE_WARNING_RATIO:
+            log.warning('Pod spec size of {} bytes is close to the budget '
+                        'of {} bytes, files: {}'.format(
+                            total, budget, file_sizes))
+        self.datastore.pod_spec_size = total
+        return True
+
+    def _build_pod_spec_with_files(self):
+        """Build the pod spec including all config files.
+
+        Returns the pod spec and the hashes of its config files.
+        """
+        pod_spec = self._build_pod_spec()
+        for updater in POD_SPEC_FILE_UPDATERS:
+            getattr(self, updater)(pod_spec)
+        return pod_spec, get_config_hashes(pod_spec)
+
     def configure_pod(self):
         """Set Juju / Kubernetes pod spec built from `_build_pod_spec()`."""
 
@@ -555,14 +2001,44 @@ class GrafanaK8s(CharmBase):
 
         # general pod spec component updates
         self.unit.status = MaintenanceStatus('Building pod spec.')
-        pod_spec = self._build_pod_spec()
-        self._update_pod_data_source_config_file(pod_spec)
-        self._update_pod_config_ini_file(pod_spec)
-
-        # set the pod spec with Juju
-        self.model.pod.set_spec(pod_spec)
+        self._probe_sources()
+        self._update_source_versions()
+        pod_spec, config_hashes = self._build_pod_spec_with_files()
+
+        # changed config file hashes will restart the pods, so only
+        # do this when no other restart is still rolling through the peers
+        if config_hashes != dict(self.datastore.config_hashes):
+            # the pods restart anyway, so also drop applied tombstones
+            if self._compact_tombstones():
+                pod_spec, config_hashes = self._build_pod_spec_with_files()
+            if not self._check_pod_spec_size(pod_spec):
+                return
+            if not self._restart_allowed():
+                self.unit.status = MaintenanceStatus(
+                    'Waiting for replicas to restart.')
+                return
+            self._start_restart_generation(config_hashes)
+
+            # remember in which generation new tombstones were applied
+            for name, generation in self.datastore.tombstones.items():
+                if generation == 0:
+                    self.datastore.tombstones[name] = \
+                        self.datastore.restart_generation
+
+        # set the pod spec with Juju and let the peers know what was set
+        self.model.pod.set_spec(pod_spec, self._build_k8s_resources())
+        self._publish_shared_state()
         self.unit.status = APPLICATION_ACTIVE_STATUS
 
+        unreachable = self._get_unreachable_sources()
+        if unreachable:
+            self.unit.status = ActiveStatus('{} {}: {}'.format(
+                APPLICATION_ACTIVE_STATUS.message,
+                'Held back unreachable data sources'
+                if self.model.config['datasource_validation'] == 'hold'
+                else 'Unreachable data sources',
+                ', '.join(unreachable)))
+
 
 if __name__ == '__main__':
     main(GrafanaK8s)
@@ -0,0 +1,209 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Caching reverse proxy for the Prometheus data sources of Grafana.
+
+This runs as a sidecar of the Grafana pod (see `query_cache_enabled`).
+Grafana's data source URL is `http://localhost:<port>/<name>`, requests
+are forwarded to the upstream of `<name>` and successful responses are
+cached, so the same range query refreshed by many viewers only reaches
+Prometheus once per TTL. It only uses the standard library, so it runs on
+any Python 3 image:
+
+    python3 query_cache.py config.json
+
+with a config file like:
+
+    {
+      "port": 3001,
+      "max_bytes": 67108864,
+      "ttl": 30,
+      "timeout": 60,
+      "upstreams": {"prometheus": "http://10.0.0.1:9090"}
+    }
+"""
+
+import argparse
+import collections
+import http.client
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger('query-cache')
+
+# request headers passed on to the upstream, the cache key includes them
+FORWARDED_HEADERS = ('Accept', 'Accept-Encoding', 'Authorization',
+                     'Content-Type')
+# response headers passed back to Grafana
+RETURNED_HEADERS = ('Content-Type', 'Content-Encoding')
+
+
+class ResponseCache:
+    """LRU cache of responses, bounded by the total size of their bodies.
+
+    Entries expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, max_bytes, ttl, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key: (expiry, response)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached (status, headers, body) response, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response):
+        """Cache a response, evicting the least recently used ones."""
+        body_size = len(response[2])
+        if body_size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + self.ttl, response)
+            self.size += body_size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self.size -= len(response[2])
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class QueryCacheHandler(http.server.BaseHTTPRequestHandler):
+    """Forward GET and POST requests to the upstream in the first path
+    segment and answer repeated ones from the cache."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._proxy(None)
+
+    def do_POST(self):
+        # Grafana sends Prometheus queries as form encoded POST requests
+        length = int(self.headers.get('Content-Length') or 0)
+        self._proxy(self.rfile.read(length))
+
+    def _proxy(self, body):
+        name, _, path = self.path.lstrip('/').partition('/')
+        upstream = self.server.upstreams.get(urllib.parse.unquote(name))
+        if upstream is None:
+            self._send((404, {'Content-Type': 'text/plain'},
+                        b'unknown data source\n'), 'MISS')
+            return
+
+        url = '{}/{}'.format(upstream.rstrip('/'), path)
+        headers = {header: self.headers[header]
+                   for header in FORWARDED_HEADERS if header in self.headers}
+        key = (self.command, url, body, tuple(sorted(headers.items())))
+
+        response = self.server.cache.get(key)
+        if response is not None:
+            self._send(response, 'HIT')
+            return
+
+        response = self._fetch(url, body, headers)
+        if response[0] == 200:
+            self.server.cache.put(key, response)
+        self._send(response, 'MISS')
+
+    def _fetch(self, url, body, headers):
+        request = urllib.request.Request(url, data=body, headers=headers,
+                                         method=self.command)
+        timeout = self.server.upstream_timeout
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as r:
+                return r.status, self._returned_headers(r.headers), r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, self._returned_headers(e.headers), e.read()
+        except (OSError, http.client.HTTPException) as e:
+            log.warning('Forwarding to {} failed: {}'.format(url, e))
+            return 502, {'Content-Type': 'text/plain'}, \
+                '{}\n'.format(e).encode()
+
+    @staticmethod
+    def _returned_headers(headers):
+        return {header: headers[header]
+                for header in RETURNED_HEADERS if header in headers}
+
+    def _send(self, response, cache_status):
+        status, headers, body = response
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class QueryCacheServer(http.server.ThreadingHTTPServer):
+    """HTTP server holding the upstreams and the shared response cache."""
+
+    daemon_threads = True
+
+    def __init__(self, address, upstreams, cache, upstream_timeout=60):
+        super().__init__(address, QueryCacheHandler)
+        self.upstreams = upstreams
+        self.cache = cache
+        self.upstream_timeout = upstream_timeout
+
+
+def make_server(config, host='127.0.0.1'):
+    """Create a server from a config dictionary (see module docstring).
+
+    It only listens on localhost, where Grafana reaches it in the pod.
+    """
+    return QueryCacheServer(
+        (host, config['port']),
+        config['upstreams'],
+        ResponseCache(config['max_bytes'], config['ttl']),
+        upstream_timeout=config.get('timeout', 60))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help='JSON config file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.config) as f:
+        config = json.load(f)
+
+    server = make_server(config)
+    log.info('Caching {} data sources on port {}.'.format(
+        len(config['upstreams']), config['port']))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
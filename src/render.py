@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Render the Grafana pod spec offline from a snapshot of the charm state.
+
+This runs the spec generation of `GrafanaK8s` outside of Juju, which is
+useful to debug the generated files and to plan for large deployments.
+
+    PYTHONPATH=src python3 -m render spec snapshot.yaml
+    PYTHONPATH=src python3 -m render diff old.yaml new.yaml
+
+A snapshot is a YAML (or JSON) document like:
+
+    config:                     # charm config, defaults from config.yaml
+      grafana_log_level: debug
+    sources:                    # one data source per grafana-source relation
+      - source-name: prometheus
+        source-type: prometheus
+        private-address: 10.0.0.1
+        port: 9090
+    database:                   # optional database relation data
+      type: mysql
+      host: 10.0.0.2:3306
+      name: grafana
+      user: grafana
+      password: secret
+    tombstones: [old-source]    # optional names of deleted data sources
+    default_source: prometheus  # optional, defaults to the first source
+"""
+
+import argparse
+import difflib
+import logging
+import sys
+import time
+
+import yaml
+from ops.testing import Harness
+
+from charm import (
+    POD_SPEC_FILE_UPDATERS,
+    GrafanaK8s,
+    get_config_hashes,
+    pack_database,
+    pack_source,
+    pod_spec_size,
+)
+
+
+def load_snapshot(path):
+    """Load a YAML or JSON snapshot file."""
+    with open(path) as snapshot_file:
+        return yaml.safe_load(snapshot_file) or {}
+
+
+def render(snapshot):
+    """Render the pod spec for a snapshot.
+
+    Returns the pod spec, the config file hashes and the time in seconds
+    each step of the spec generation took.
+    """
+    harness = Harness(GrafanaK8s)
+    try:
+        harness.begin()
+        with harness.hooks_disabled():
+            harness.update_config(snapshot.get('config', {}))
+            harness.set_leader(True)
+
+        charm = harness.charm
+        sources = snapshot.get('sources', [])
+        for rel_id, source in enumerate(sources):
+            source = dict(source)
+            source.setdefault('unit_name', source['source-name'])
+            source.setdefault('version', 1)
+            source['port'] = str(source['port'])
+            charm.datastore.sources[rel_id] = pack_source(source)
+            charm.datastore.source_names.add(source['source-name'])
+        charm.datastore.default_source = snapshot.get(
+            'default_source', sources[0]['source-name'] if sources else '')
+        charm.datastore.database = pack_database(snapshot.get('database'))
+        for name in snapshot.get('tombstones', []):
+            charm.datastore.tombstones[name] = 0
+
+        timings = {}
+        start = time.perf_counter()
+        pod_spec = charm._build_pod_spec()
+        timings['_build_pod_spec'] = time.perf_counter() - start
+
+        # the same steps as `GrafanaK8s._build_pod_spec_with_files()`
+        for updater in POD_SPEC_FILE_UPDATERS:
+            start = time.perf_counter()
+            getattr(charm, updater)(pod_spec)
+            timings[updater] = time.perf_counter() - start
+
+        return pod_spec, get_config_hashes(pod_spec), timings
+    finally:
+        harness.cleanup()
+
+
+def get_files(pod_spec):
+    """Get the generated files of a pod spec keyed by their mount path."""
+    files = {}
+    for container in pod_spec['containers']:
+        for file_meta in container['files']:
+            # volumes of Secrets have no generated files
+            for file_name, text in file_meta.get('files', {}).items():
+                files['{}/{}'.format(file_meta['mountPath'], file_name)] = text
+    return files
+
+
+def spec_command(args):
+    pod_spec, hashes, timings = render(load_snapshot(args.snapshot))
+    if not args.quiet:
+        print(yaml.safe_dump(pod_spec, default_flow_style=False))
+
+    total, file_sizes = pod_spec_size(pod_spec)
+    print('# size: {} bytes'.format(total))
+    for name, size in sorted(file_sizes.items()):
+        print('#   {}: {} bytes'.format(name, size))
+    print('# hashes:')
+    for key, file_hash in sorted(hashes.items()):
+        print('#   {}: {}'.format(key, file_hash))
+    print('# timings:')
+    for step, duration in timings.items():
+        print('#   {}: {:.3f}ms'.format(step, duration * 1000))
+    return 0
+
+
+def diff_command(args):
+    old_spec, old_hashes, _ = render(load_snapshot(args.old))
+    new_spec, new_hashes, _ = render(load_snapshot(args.new))
+
+    keys = sorted(set(old_hashes) | set(new_hashes))
+    changed = [key for key in keys
+               if old_hashes.get(key) != new_hashes.get(key)]
+    for key in keys:
+        print('{}: {} -> {}{}'.format(
+            key, old_hashes.get(key), new_hashes.get(key),
+            ' (changed)' if key in changed else ''))
+
+    old_files, new_files = get_files(old_spec), get_files(new_spec)
+    for path in sorted(set(old_files) | set(new_files)):
+        sys.stdout.writelines(difflib.unified_diff(
+            old_files.get(path, '').splitlines(keepends=True),
+            new_files.get(path, '').splitlines(keepends=True),
+            fromfile='{}:{}'.format(args.old, path),
+            tofile='{}:{}'.format(args.new, path)))
+
+    if changed:
+        print('Pods would restart, changed: {}'.format(', '.join(changed)))
+        return 1
+    print('Pods would not restart.')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    spec_parser = subparsers.add_parser(
+        'spec', help='print the pod spec, file hashes and timings')
+    spec_parser.add_argument('snapshot')
+    spec_parser.add_argument('-q', '--quiet', action='store_true',
+                             help="don't print the pod spec itself")
+    spec_parser.set_defaults(func=spec_command)
+
+    diff_parser = subparsers.add_parser(
+        'diff', help='show which file changes would restart the pods')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+    diff_parser.set_defaults(func=diff_command)
+
+    args = parser.parse_args(argv)
+    logging.disable(logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Relation churn load simulator for the Grafana charm.
+
+Drives a `GrafanaK8s` instance in an `ops.testing.Harness` through many
+randomized grafana-source joins, changes and departures, database flaps,
+peer scale-ups, leader changes and update-status hooks (which is when
+the replicas acknowledge restarts) and records:
+
+- the latency from an event to the resulting `set_spec` call
+- the number of `set_spec` calls and pod restarts (restart generations)
+- the growth of the pickled StoredState
+
+    PYTHONPATH=src python3 -m tests.load_simulator --events 2000 --seed 1
+"""
+
+import argparse
+import copy
+import logging
+import pickle
+import random
+import time
+
+from ops.testing import Harness
+
+from charm import GrafanaK8s
+
+DATABASE = {
+    'type': 'mysql',
+    'host': '10.0.0.1:3306',
+    'name': 'grafana',
+    'user': 'grafana',
+    'password': 'password',
+}
+
+# relative weight of every kind of event
+EVENT_WEIGHTS = {
+    'source_join': 10,
+    'source_change': 6,
+    'source_depart': 4,
+    'database_flap': 1,
+    'peer_join': 1,
+    'leader_change': 1,
+    'update_status': 4,
+}
+
+
+def percentile(values, fraction):
+    """Get the nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1,
+                       int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class LoadSimulator:
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.harness = Harness(GrafanaK8s)
+        self.harness.begin()
+        # StoredState of a unit that was never the leader
+        self.initial_state = copy.deepcopy(
+            self.harness.charm.datastore._data.snapshot())
+        self.harness.update_config({})
+        self.harness.set_leader(True)
+
+        self.sources = {}  # rel_id: remote unit name
+        self.next_app = 0
+        self.peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.peers = 0
+        self.db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(self.db_rel_id, 'mysql/0')
+        self.harness.update_relation_data(self.db_rel_id, 'mysql/0', DATABASE)
+
+        # there is no Grafana to health check, assume it always comes up
+        # with the new pod spec right away
+        self.harness.charm._grafana_is_healthy = lambda: True
+        self.harness.charm._grafana_process_start_time = time.time
+
+        # record every set_spec call of the charm
+        self.set_spec_times = []
+        pod = self.harness.charm.model.pod
+        set_spec = pod.set_spec
+
+        def timed_set_spec(*args, **kwargs):
+            self.set_spec_times.append(time.perf_counter())
+            return set_spec(*args, **kwargs)
+        pod.set_spec = timed_set_spec
+
+    def source_join(self):
+        app = 'source-{}'.format(self.next_app)
+        self.next_app += 1
+        unit = '{}/0'.format(app)
+        rel_id = self.harness.add_relation('grafana-source', app)
+        self.harness.add_relation_unit(rel_id, unit)
+        self.harness.update_relation_data(rel_id, unit, {
+            'private-address': '10.1.{}.{}'.format(self.next_app // 256 % 256,
+                                                   self.next_app % 256),
+            'port': '9090',
+            'source-type': self.random.choice(['prometheus', 'graphite']),
+            'source-name': app,
+        })
+        self.sources[rel_id] = unit
+
+    def source_change(self):
+        if not self.sources:
+            return self.source_join()
+        rel_id = self.random.choice(sorted(self.sources))
+        self.harness.update_relation_data(rel_id, self.sources[rel_id], {
+            'port': str(self.random.randint(1024, 65535))})
+
+    def source_depart(self):
+        if not self.sources:
+            return self.source_join()
+        rel_id = self.random.choice(sorted(self.sources))
+        unit = self.sources.pop(rel_id)
+        # the departed unit's data leaves the model, so later rebuilds
+        # from relation data don't bring the source back
+        with self.harness.hooks_disabled():
+            self.harness.update_relation_data(rel_id, unit, dict.fromkeys(
+                self.harness.get_relation_data(rel_id, unit)))
+        relation = self.harness.model.get_relation('grafana-source', rel_id)
+        relation.units.clear()
+        self.harness.charm.on['grafana-source'].relation_departed.emit(
+            relation)
+
+    def database_flap(self):
+        relation = self.harness.model.get_relation('database', self.db_rel_id)
+        self.harness.charm.on['database'].relation_departed.emit(relation)
+        self.harness.update_relation_data(self.db_rel_id, 'mysql/0',
+                                          {'host': None})
+        self.harness.update_relation_data(self.db_rel_id, 'mysql/0', DATABASE)
+
+    def peer_join(self):
+        self.peers += 1
+        unit = 'grafana/{}'.format(self.peers)
+        self.harness.add_relation_unit(self.peer_rel_id, unit)
+        self.harness.update_relation_data(self.peer_rel_id, unit,
+                                          {'private-address': '10.2.0.1'})
+
+    def leader_change(self):
+        """Fail over to a unit that was never the leader.
+
+        The Harness only runs a single unit, so its StoredState is reset
+        to the one of a fresh unit, which has to take over the state from
+        the peer app data and the relations.
+        """
+        self.harness.set_leader(False)
+        datastore = self.harness.charm.datastore
+        for name, value in copy.deepcopy(self.initial_state).items():
+            setattr(datastore, name, value)
+        self.harness.set_leader(True)
+
+    def update_status(self):
+        self.harness.charm.on.update_status.emit()
+
+    def state_size(self):
+        """Size in bytes of the pickled StoredState of the charm."""
+        return len(pickle.dumps(self.harness.charm.datastore._data.snapshot()))
+
+    def run(self, events):
+        kinds = sorted(EVENT_WEIGHTS)
+        weights = [EVENT_WEIGHTS[kind] for kind in kinds]
+        latencies = []
+        counts = dict.fromkeys(kinds, 0)
+        set_spec_calls = len(self.set_spec_times)
+        generation = self.harness.charm.datastore.restart_generation
+        initial_state_size = self.state_size()
+
+        for kind in self.random.choices(kinds, weights, k=events):
+            counts[kind] += 1
+            calls = len(self.set_spec_times)
+            start = time.perf_counter()
+            getattr(self, kind)()
+            if len(self.set_spec_times) > calls:
+                latencies.append(self.set_spec_times[-1] - start)
+
+        restarts = self.harness.charm.datastore.restart_generation - generation
+        return {
+            'events': counts,
+            'set_spec_calls': len(self.set_spec_times) - set_spec_calls,
+            'restarts': restarts,
+            'latency_p50': percentile(latencies, 0.50),
+            'latency_p95': percentile(latencies, 0.95),
+            'latency_p99': percentile(latencies, 0.99),
+            'sources': len(self.harness.charm.datastore.sources),
+            'related_sources': len(self.sources),
+            'state_size_before': initial_state_size,
+            'state_size_after': self.state_size(),
+        }
+
+
+def simulate(events, seed=0):
+    """Run a simulation of the given number of events and get its results."""
+    simulator = LoadSimulator(seed)
+    try:
+        return simulator.run(events)
+    finally:
+        simulator.harness.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = simulate(args.events, args.seed)
+    print('events: {}'.format(', '.join(
+        '{}={}'.format(kind, count)
+        for kind, count in sorted(results['events'].items()))))
+    print('set_spec calls: {}, restarts: {}, sources: {} of {}'.format(
+        results['set_spec_calls'], results['restarts'], results['sources'],
+        results['related_sources']))
+    print('event -> set_spec latency: p50={:.2f}ms p95={:.2f}ms '
+          'p99={:.2f}ms'.format(results['latency_p50'] * 1000,
+                                results['latency_p95'] * 1000,
+                                results['latency_p99'] * 1000))
+    print('StoredState: {} -> {} bytes'.format(
+        results['state_size_before'], results['state_size_after']))
+
+
+if __name__ == '__main__':
+    main()
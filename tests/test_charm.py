@@ -1,9 +1,21 @@
 import hashlib
+import http.server
+import json
+import os
+import re
+import socket
+import sqlite3
+import tempfile
 import textwrap
+import threading
+import time
 import unittest
+from unittest import mock
 
 from ops.testing import Harness
 from ops.model import (
+    BlockedStatus,
+    Model,
     TooManyRelatedAppsError
 )
 from charm import (
@@ -12,7 +24,14 @@ from charm import (
     HA_NOT_READY_STATUS,
     HA_READY_STATUS,
     SINGLE_NODE_STATUS,
+    decode_shared_state,
+    encode_shared_state,
     get_container,
+    pack_source,
+    pod_spec_size,
+    probe_endpoints,
+    sqlite_maintenance,
+    unpack_source,
 )
 
 BASE_CONFIG = {
@@ -44,6 +63,32 @@ MISSING_IMAGE_CONFIG = {
 }
 
 
+class StubDataSource(http.server.BaseHTTPRequestHandler):
+    """A local data source answering every request with 404."""
+
+    def do_GET(self):
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_data_source(test_case):
+    """Serve a stub data source on localhost for the test, get its port."""
+    server = http.server.HTTPServer(('127.0.0.1', 0), StubDataSource)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return server.server_address[1]
+
+
+def get_closed_port():
+    """Get a localhost port nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
 class GrafanaCharmTest(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -55,7 +100,7 @@ class GrafanaCharmTest(unittest.TestCase):
 
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
-        self.assertEqual(self.harness.charm.datastore.sources, {})
+        self.assertEqual(self.harness.charm.sources, {})
 
         rel_id = self.harness.add_relation('grafana-source', 'prometheus')
         self.harness.add_relation_unit(rel_id, 'prometheus/0')
@@ -77,11 +122,11 @@ class GrafanaCharmTest(unittest.TestCase):
             'port': 1234,
             'source-name': 'prometheus-app',
             'source-type': 'prometheus',
-            'isDefault': 'true',
-            'unit_name': 'prometheus/0'
+            'unit_name': 'prometheus/0',
+            'version': 1,
         }
         self.assertEqual(expected_first_source_data,
-                         dict(self.harness.charm.datastore.sources[rel_id]))
+                         self.harness.charm.sources[rel_id])
 
         # test that clearing the relation data leads to
         # the datastore for this data source being cleared
@@ -160,7 +205,7 @@ class GrafanaCharmTest(unittest.TestCase):
     def test__database_relation_data(self):
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
-        self.assertEqual(self.harness.charm.datastore.database, {})
+        self.assertEqual(self.harness.charm.database, {})
 
         # add relation and update relation data
         rel_id = self.harness.add_relation('database', 'mysql')
@@ -177,17 +222,17 @@ class GrafanaCharmTest(unittest.TestCase):
                                           'mysql/0',
                                           test_relation_data)
         # check that charm datastore was properly set
-        self.assertEqual(dict(self.harness.charm.datastore.database),
+        self.assertEqual(self.harness.charm.database,
                          test_relation_data)
 
         # now depart this relation and ensure the datastore is emptied
         self.harness.charm.on.database_relation_departed.emit(rel)
-        self.assertEqual({}, dict(self.harness.charm.datastore.database))
+        self.assertEqual({}, self.harness.charm.database)
 
     def test__multiple_database_relation_handling(self):
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
-        self.assertEqual(self.harness.charm.datastore.database, {})
+        self.assertEqual(self.harness.charm.database, {})
 
         # add first database relation
         self.harness.add_relation('database', 'mysql')
@@ -203,7 +248,7 @@ class GrafanaCharmTest(unittest.TestCase):
         Specifically, it will test multiple grafana-source relations."""
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
-        self.assertEqual(self.harness.charm.datastore.sources, {})
+        self.assertEqual(self.harness.charm.sources, {})
 
         # add first relation
         rel_id0 = self.harness.add_relation('grafana-source', 'prometheus')
@@ -229,6 +274,7 @@ class GrafanaCharmTest(unittest.TestCase):
               isDefault: true
               editable: true
               orgId: 1
+              version: 1
               basicAuthUser: {0}
               secureJsonData:
                 basicAuthPassword: {1}""").format(
@@ -257,6 +303,7 @@ class GrafanaCharmTest(unittest.TestCase):
               isDefault: false
               editable: true
               orgId: 1
+              version: 1
               basicAuthUser: {0}
               secureJsonData:
                 basicAuthPassword: {1}""").format(
@@ -291,6 +338,7 @@ class GrafanaCharmTest(unittest.TestCase):
               isDefault: true
               editable: true
               orgId: 1
+              version: 1
               basicAuthUser: {0}
               secureJsonData:
                 basicAuthPassword: {1}""").format(
@@ -299,10 +347,50 @@ class GrafanaCharmTest(unittest.TestCase):
 
         self.assertEqual(correct_text_after_removal + '\n', generated_text)
 
+        # the tombstone is kept until the deletion has been applied
+        generated_text = self.harness.charm._make_data_source_config_text()
+        self.assertEqual(correct_text_after_removal + '\n', generated_text)
+
         # now test that the 'deleteDatasources' is gone
+        self.assertTrue(self.harness.charm._compact_tombstones())
         generated_text = self.harness.charm._make_data_source_config_text()
         self.assertEqual(correct_config_text0 + '\n', generated_text)
 
+    def test__default_source_kept(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        rel_id = self.harness.add_relation('grafana-source', 'thanos')
+        self.harness.add_relation_unit(rel_id, 'thanos/0')
+
+        def publish(*names):
+            self.harness.update_relation_data(rel_id, 'thanos', {
+                'datasources': json.dumps([{
+                    'source-name': name,
+                    'source-type': 'prometheus',
+                    'private-address': '192.0.2.1',
+                    'port': 9090,
+                } for name in names])})
+
+        def default_sources():
+            datasources = self.harness.charm._make_data_source_config_text()
+            return re.findall(r'- name: (\S+)\n.*\n.*\n.*\n'
+                              r'  isDefault: true', datasources)
+
+        # a source added later doesn't take over the default, even if
+        # it sorts first by name
+        publish('zprom')
+        publish('zprom', 'alerts')
+        self.assertEqual(self.harness.charm.datastore.default_source, 'zprom')
+        self.assertEqual(default_sources(), ['zprom'])
+
+        # a new default is only picked once the default one is removed
+        publish('alerts', 'mimir')
+        self.assertEqual(self.harness.charm.datastore.default_source,
+                         'alerts')
+        self.assertEqual(default_sources(), ['alerts'])
+        publish()
+        self.assertEqual(self.harness.charm.datastore.default_source, '')
+
     def test__check_config_missing_image_path(self):
         self.harness.update_config(MISSING_IMAGE_PASSWORD_CONFIG)
 
@@ -322,7 +410,7 @@ class GrafanaCharmTest(unittest.TestCase):
     def test__pod_spec_container_datasources(self):
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
-        self.assertEqual(self.harness.charm.datastore.sources, {})
+        self.assertEqual(self.harness.charm.sources, {})
 
         # add first relation
         rel_id = self.harness.add_relation('grafana-source', 'prometheus')
@@ -348,6 +436,7 @@ class GrafanaCharmTest(unittest.TestCase):
               isDefault: true
               editable: true
               orgId: 1
+              version: 1
               basicAuthUser: {0}
               secureJsonData:
                 basicAuthPassword: {1}
@@ -359,6 +448,13 @@ class GrafanaCharmTest(unittest.TestCase):
         [paths]
         provisioning = {0}
 
+        [server]
+        protocol = http
+        http_port = 3000
+        enable_gzip = false
+        router_logging = false
+        read_timeout = 0s
+
         [security]
         admin_user = {1}
         admin_password = {2}
@@ -366,6 +462,16 @@ class GrafanaCharmTest(unittest.TestCase):
         [log]
         mode = {3}
         level = {4}
+
+        [log.file]
+        log_rotate = true
+        max_lines = 1000000
+        max_size_shift = 28
+        daily_rotate = true
+        max_days = 7
+
+        [live]
+        max_connections = 100
         """).format(
             self.harness.model.config['provisioning_path'],
             self.harness.model.config['basic_auth_username'],
@@ -396,6 +502,210 @@ class GrafanaCharmTest(unittest.TestCase):
         self.assertEqual(expected_container_files_spec,
                          actual_container_files_spec)
 
+    def test__pod_spec_probes(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'liveness_probe_period': 30})
+        container = get_container(self.harness.get_pod_spec()[0], 'grafana')
+
+        self.assertEqual(container['startupProbe'], {
+            'httpGet': {'path': '/api/health', 'port': 3000,
+                        'scheme': 'HTTP'},
+            'initialDelaySeconds': 0,
+            'periodSeconds': 1,
+            'timeoutSeconds': 1,
+            'failureThreshold': 120,
+        })
+        self.assertEqual(container['readinessProbe']['initialDelaySeconds'], 0)
+        self.assertEqual(container['livenessProbe']['periodSeconds'], 30)
+
+    def test__check_config_invalid_probe_timings(self):
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'readiness_probe_timeout': 0})
+        missing = self.harness.charm._check_config()
+        self.assertEqual(missing, ['readiness_probe_timeout'])
+
+    def test__log_config(self):
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({
+            'grafana_log_mode': 'console',
+            'grafana_log_level': 'warn',
+            'grafana_log_filters': 'rendering:debug  sqlstore:error',
+            'log_console_format': 'json',
+        })
+        config_ini = self.harness.charm._make_config_ini_text()
+        self.assertIn(textwrap.dedent("""
+        [log]
+        mode = console
+        level = warn
+        filters = rendering:debug sqlstore:error
+
+        [log.console]
+        format = json
+        """), config_ini)
+        self.assertNotIn('[log.file]', config_ini)
+
+        self.harness.update_config({'grafana_log_mode': 'console file',
+                                    'log_file_max_days': 3})
+        config_ini = self.harness.charm._make_config_ini_text()
+        self.assertIn('\n[log.file]\n', config_ini)
+        self.assertIn('\nmax_days = 3\n', config_ini)
+        self.assertIn('\n[log.console]\n', config_ini)
+
+    def test__check_config_invalid_log_config(self):
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({
+            'grafana_log_mode': 'file journald',
+            'grafana_log_level': 'verbose',
+            'grafana_log_filters': 'rendering:debug sqlstore',
+            'log_file_max_size_shift': 0,
+            'log_console_format': 'xml',
+        })
+        self.assertEqual(self.harness.charm._check_config(), [
+            'grafana_log_mode',
+            'grafana_log_level',
+            'grafana_log_filters',
+            'log_file_max_size_shift',
+            'log_console_format',
+        ])
+
+    @mock.patch.object(GrafanaK8s, '_grafana_process_start_time',
+                       side_effect=time.time)
+    @mock.patch.object(GrafanaK8s, '_grafana_is_healthy', return_value=True)
+    def test__live_ha_engine(self, *_):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'live_max_connections': 5000})
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        self.harness.update_relation_data(db_rel_id, 'mysql/0', {
+            'type': 'mysql',
+            'host': '0.1.2.3:3306',
+            'name': 'my-test-db',
+            'user': 'test-user',
+            'password': 'password',
+        })
+
+        # without redis every replica only streams its own messages
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(self.harness.charm._check_high_availability(),
+                             HA_READY_STATUS)
+        self.assertIn('redis', logs.output[0])
+        self.assertIn('\n[live]\nmax_connections = 5000\n\n[database]',
+                      self.harness.charm._make_config_ini_text())
+
+        # incomplete redis data is ignored
+        redis_rel_id = self.harness.add_relation('redis', 'redis')
+        self.harness.add_relation_unit(redis_rel_id, 'redis/0')
+        self.harness.update_relation_data(redis_rel_id, 'redis/0',
+                                          {'hostname': '10.0.0.7'})
+        self.assertFalse(self.harness.charm.has_redis)
+
+        self.harness.update_relation_data(redis_rel_id, 'redis/0', {
+            'port': '6379', 'password': 's3cret'})
+        self.assertTrue(self.harness.charm.has_redis)
+        container = get_container(self.harness.get_pod_spec()[0], 'grafana')
+        self.assertIn(textwrap.dedent("""
+        [live]
+        max_connections = 5000
+        ha_engine = redis
+        ha_engine_address = 10.0.0.7:6379
+        ha_engine_password = s3cret
+        """), container['files'][1]['files']['grafana.ini'])
+        shared_state = decode_shared_state(
+            self.harness.get_relation_data(peer_rel_id, 'grafana')[
+                'grafana-state'])
+        self.assertEqual(shared_state['redis_address'], '10.0.0.7:6379')
+
+        # a new leader finds redis in the relation data
+        self.harness.charm.datastore.redis_address = ''
+        self.harness.charm._rebuild_datastore_from_relations()
+        self.assertEqual(self.harness.charm.datastore.redis_address,
+                         '10.0.0.7:6379')
+
+        relation = self.harness.model.get_relation('redis', redis_rel_id)
+        self.harness.charm.on['redis'].relation_departed.emit(relation)
+        self.assertNotIn('ha_engine',
+                         self.harness.charm._make_config_ini_text())
+
+    def test__server_performance_profile(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'server_enable_gzip': True,
+                                    'server_router_logging': True,
+                                    'server_read_timeout': 30})
+        config_ini = self.harness.charm._make_config_ini_text()
+        self.assertIn(textwrap.dedent("""
+        [server]
+        protocol = http
+        http_port = 3000
+        enable_gzip = true
+        router_logging = true
+        read_timeout = 30s
+        """), config_ini)
+        self.assertNotIn('cert_file', config_ini)
+        container = get_container(self.harness.get_pod_spec()[0], 'grafana')
+        self.assertNotIn('GRAFANA_TLS', container['config'])
+
+    def test__server_http2_with_tls(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+
+        # HTTP/2 needs TLS material
+        self.harness.update_config({'server_protocol': 'h2'})
+        self.assertEqual(self.harness.charm._check_config(),
+                         ['tls_cert', 'tls_key'])
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+
+        self.harness.update_config({'tls_cert': 'CERT', 'tls_key': 'KEY'})
+        self.assertEqual(self.harness.charm.unit.status,
+                         APPLICATION_ACTIVE_STATUS)
+        container = get_container(self.harness.get_pod_spec()[0], 'grafana')
+        config_ini = container['files'][1]['files']['grafana.ini']
+        self.assertIn('protocol = h2\n', config_ini)
+        self.assertIn('cert_file = /etc/grafana/tls/grafana.crt\n'
+                      'cert_key = /etc/grafana/tls-key/grafana.key\n',
+                      config_ini)
+        self.assertEqual(container['files'][2], {
+            'name': 'grafana-tls',
+            'mountPath': '/etc/grafana/tls',
+            'files': {'grafana.crt': 'CERT'},
+        })
+
+        # the key is not part of any ConfigMap, only of the Secret
+        self.assertEqual(container['files'][3], {
+            'name': 'grafana-tls-key',
+            'mountPath': '/etc/grafana/tls-key',
+            'secret': {
+                'name': 'grafana-tls',
+                'files': [{'key': 'grafana.key', 'path': 'grafana.key'}],
+            },
+        })
+        self.assertNotIn('KEY', json.dumps(self.harness.get_pod_spec()[0]))
+        self.assertEqual(self.harness.get_pod_spec()[1], {
+            'kubernetesResources': {
+                'secrets': [{
+                    'name': 'grafana-tls',
+                    'type': 'Opaque',
+                    'stringData': {'grafana.key': 'KEY'},
+                }],
+            },
+        })
+        self.assertEqual(container['readinessProbe']['httpGet']['scheme'],
+                         'HTTPS')
+
+        # a renewed certificate restarts Grafana through its hash
+        tls_hash = container['config']['GRAFANA_TLS']
+        self.harness.update_config({'tls_cert': 'NEW CERT'})
+        container = get_container(self.harness.get_pod_spec()[0], 'grafana')
+        self.assertNotEqual(container['config']['GRAFANA_TLS'], tls_hash)
+
+        self.harness.update_config({'server_protocol': 'spdy'})
+        self.assertEqual(self.harness.charm._check_config(),
+                         ['server_protocol'])
+
     def test__access_sqlite_storage_location(self):
         expected_path = '/var/lib/grafana'
         actual_path = self.harness.charm.meta.storages['sqlitedb'].location
@@ -407,6 +717,13 @@ class GrafanaCharmTest(unittest.TestCase):
         [paths]
         provisioning = {0}
 
+        [server]
+        protocol = http
+        http_port = 3000
+        enable_gzip = false
+        router_logging = false
+        read_timeout = 0s
+
         [security]
         admin_user = {1}
         admin_password = {2}
@@ -414,6 +731,16 @@ class GrafanaCharmTest(unittest.TestCase):
         [log]
         mode = {3}
         level = {4}
+
+        [log.file]
+        log_rotate = true
+        max_lines = 1000000
+        max_size_shift = 28
+        daily_rotate = true
+        max_days = 7
+
+        [live]
+        max_connections = 100
         """).format(
             self.harness.model.config['provisioning_path'],
             self.harness.model.config['basic_auth_username'],
@@ -449,6 +776,13 @@ class GrafanaCharmTest(unittest.TestCase):
         [paths]
         provisioning = {0}
 
+        [server]
+        protocol = http
+        http_port = 3000
+        enable_gzip = false
+        router_logging = false
+        read_timeout = 0s
+
         [security]
         admin_user = {1}
         admin_password = {2}
@@ -457,6 +791,16 @@ class GrafanaCharmTest(unittest.TestCase):
         mode = {3}
         level = {4}
 
+        [log.file]
+        log_rotate = true
+        max_lines = 1000000
+        max_size_shift = 28
+        daily_rotate = true
+        max_days = 7
+
+        [live]
+        max_connections = 100
+
         [database]
         type = mysql
         host = 0.1.2.3:3306
@@ -474,10 +818,536 @@ class GrafanaCharmTest(unittest.TestCase):
         actual_config_text = self.harness.charm._make_config_ini_text()
         self.assertEqual(expected_config_text, actual_config_text)
 
+    def test__config_ini_sqlite_performance_mode(self):
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'sqlite_performance_mode': True,
+                                    'sqlite_lock_retries': 10})
+        expected_config_text = textwrap.dedent("""
+        [database]
+        type = sqlite3
+        path = grafana.db
+        cache_mode = shared
+        wal = true
+        query_retries = 10
+        transaction_retries = 10""")
+        actual_config_text = self.harness.charm._make_config_ini_text()
+        self.assertTrue(actual_config_text.endswith(expected_config_text))
+
+        # a related database always takes precedence over sqlite3
+        self.harness.set_leader(True)
+        rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(rel_id, 'mysql/0')
+        self.harness.update_relation_data(rel_id,
+                                          'mysql/0',
+                                          {
+                                              'type': 'mysql',
+                                              'host': '0.1.2.3:3306',
+                                              'name': 'my-test-db',
+                                              'user': 'test-user',
+                                              'password': 'password',
+                                          })
+        actual_config_text = self.harness.charm._make_config_ini_text()
+        self.assertNotIn('sqlite3', actual_config_text)
+
+    def test__check_config_invalid_sqlite_cache_mode(self):
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'sqlite_performance_mode': True,
+                                    'sqlite_cache_mode': 'bogus'})
+        missing = self.harness.charm._check_config()
+        self.assertEqual(missing, ['sqlite_cache_mode'])
+
+    def test__sqlite_maintenance(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'grafana.db')
+            connection = sqlite3.connect(db_path)
+            connection.execute('CREATE TABLE dashboard (data TEXT)')
+            connection.executemany('INSERT INTO dashboard VALUES (?)',
+                                   [('x' * 1024,)] * 100)
+            connection.execute('DELETE FROM dashboard')
+            connection.commit()
+            connection.close()
+
+            results = sqlite_maintenance(db_path)
+            self.assertLess(results['size-after'], results['size-before'])
+
+            with self.assertRaises(FileNotFoundError):
+                sqlite_maintenance(os.path.join(tmp, 'missing.db'))
+
+    @mock.patch.object(GrafanaK8s, '_grafana_process_start_time',
+                       side_effect=time.time)
+    @mock.patch.object(GrafanaK8s, '_grafana_is_healthy', return_value=True)
+    def test__rolling_restart_generations(self, *_):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        self.harness.update_relation_data(db_rel_id,
+                                          'mysql/0',
+                                          {
+                                              'type': 'mysql',
+                                              'host': '0.1.2.3:3306',
+                                              'name': 'my-test-db',
+                                              'user': 'test-user',
+                                              'password': 'password',
+                                          })
+        generation = self.harness.charm.datastore.restart_generation
+        self.assertEqual(
+            self.harness.charm._shared_state()['restart_generation'],
+            generation)
+
+        # both replicas report a healthy Grafana for this generation
+        self.harness.charm.on.update_status.emit()
+        self.harness.update_relation_data(peer_rel_id, 'grafana/1',
+                                          {'restart-ack': str(generation)})
+        self.assertEqual(
+            self.harness.get_relation_data(peer_rel_id, 'grafana/0'),
+            {'restart-ack': str(generation)})
+
+        # a config change starts the next generation right away
+        self.harness.update_config({'grafana_log_level': 'debug'})
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         generation + 1)
+        self.assertEqual(self.harness.charm.unit.status,
+                         APPLICATION_ACTIVE_STATUS)
+        self.harness.charm.on.update_status.emit()
+
+        # but another change has to wait for grafana/1 to come back up
+        self.harness.update_config({'grafana_log_level': 'warn'})
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         generation + 1)
+        self.assertEqual(self.harness.charm.unit.status.name, 'maintenance')
+        pod_spec = self.harness.get_pod_spec()[0]
+        config_ini = get_container(pod_spec, 'grafana')['files'][1]
+        self.assertIn('level = debug', config_ini['files']['grafana.ini'])
+
+        # once it acknowledges the restart, the waiting change is rolled out
+        self.harness.update_relation_data(peer_rel_id, 'grafana/1',
+                                          {'restart-ack': str(generation + 1)})
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         generation + 2)
+        pod_spec = self.harness.get_pod_spec()[0]
+        config_ini = get_container(pod_spec, 'grafana')['files'][1]
+        self.assertIn('level = warn', config_ini['files']['grafana.ini'])
+
+    @mock.patch.object(GrafanaK8s, '_grafana_process_start_time',
+                       side_effect=time.time)
+    @mock.patch.object(GrafanaK8s, '_grafana_is_healthy', return_value=True)
+    def test__restart_ack_timeout(self, *_):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        self.harness.update_relation_data(db_rel_id, 'mysql/0', {
+            'type': 'mysql',
+            'host': '0.1.2.3:3306',
+            'name': 'my-test-db',
+            'user': 'test-user',
+            'password': 'password',
+        })
+        self.harness.charm.on.update_status.emit()
+        self.harness.update_relation_data(peer_rel_id, 'grafana/1', {
+            'restart-ack': str(self.harness.charm.datastore.restart_generation)})
+        self.harness.update_config({'grafana_log_level': 'debug'})
+        generation = self.harness.charm.datastore.restart_generation
+
+        # grafana/1 never acknowledges, so the next change is held back
+        self.harness.update_config({'grafana_log_level': 'warn'})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         generation)
+        self.assertEqual(self.harness.charm.unit.status.message,
+                         'Waiting for replicas to restart.')
+
+        # and rolled out by update-status once the timeout ran out
+        self.harness.charm.datastore.restart_started -= \
+            self.harness.model.config['restart_ack_timeout'] + 1
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         generation + 1)
+        pod_spec = self.harness.get_pod_spec()[0]
+        config_ini = get_container(pod_spec, 'grafana')['files'][1]
+        self.assertIn('level = warn', config_ini['files']['grafana.ini'])
+
+        # without pending changes update-status does not set the spec
+        with mock.patch.object(self.harness.charm, 'configure_pod') as configure:
+            self.harness.charm.on.update_status.emit()
+            configure.assert_not_called()
+
+    @mock.patch.object(GrafanaK8s, '_grafana_process_start_time')
+    @mock.patch.object(GrafanaK8s, '_grafana_is_healthy', return_value=True)
+    def test__restart_ack_needs_restarted_grafana(self, _, start_time):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        self.harness.update_relation_data(db_rel_id, 'mysql/0', {
+            'type': 'mysql',
+            'host': '0.1.2.3:3306',
+            'name': 'my-test-db',
+            'user': 'test-user',
+            'password': 'password',
+        })
+        generation = self.harness.charm.datastore.restart_generation
+        started = self.harness.charm._shared_state()['restart_started']
+        self.assertEqual(started, self.harness.charm.datastore.restart_started)
+
+        # the old pod is healthy but was not replaced with the new spec
+        start_time.return_value = started - 60
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.get_relation_data(peer_rel_id, 'grafana/0'), {})
+
+        # so is Grafana without metrics
+        start_time.return_value = None
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.get_relation_data(peer_rel_id, 'grafana/0'), {})
+
+        start_time.return_value = started + 1
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.get_relation_data(peer_rel_id, 'grafana/0'),
+            {'restart-ack': str(generation)})
+
+    def test__grafana_process_start_time(self):
+        self.harness.update_config(BASE_CONFIG)
+        with mock.patch.object(self.harness.charm, '_grafana_request') \
+                as request:
+            request.return_value = textwrap.dedent("""
+            # HELP process_start_time_seconds Start time of the process.
+            # TYPE process_start_time_seconds gauge
+            process_start_time_seconds 1.60245623612e+09
+            """)
+            self.assertEqual(
+                self.harness.charm._grafana_process_start_time(),
+                1602456236.12)
+            request.assert_called_once_with('/metrics')
+            request.return_value = None
+            self.assertIsNone(
+                self.harness.charm._grafana_process_start_time())
+
+    def test__datasource_versions(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        source_data = {
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'source-type': 'prometheus',
+            'source-name': 'prometheus-app',
+        }
+        self.harness.update_relation_data(rel_id, 'prometheus/0', source_data)
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 1)
+
+        # unrelated relation data does not change the data source
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'unrelated': 'value'})
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 1)
+
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'port': '4321'})
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 2)
+
+        # a re-added source continues with the next version
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'port': None})
+        self.assertEqual(dict(self.harness.charm.datastore.tombstones),
+                         {'prometheus-app': self.harness.charm.datastore.restart_generation})
+        self.harness.update_relation_data(rel_id, 'prometheus/0', source_data)
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 3)
+        self.assertEqual(dict(self.harness.charm.datastore.tombstones), {})
+
+        # the rendered entry also depends on the config
+        self.harness.update_config({'basic_auth_username': 'viewer'})
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 4)
+        self.harness.charm.configure_pod()
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 4)
+
+        # and on which source is the default one
+        j_rel_id = self.harness.add_relation('grafana-source', 'jaeger')
+        self.harness.add_relation_unit(j_rel_id, 'jaeger/0')
+        self.harness.update_relation_data(j_rel_id, 'jaeger/0', dict(
+            source_data, **{'source-type': 'jaeger', 'source-name': 'jaeger'}))
+        self.assertEqual(self.harness.charm.sources[j_rel_id]['version'], 1)
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'port': None})
+        self.assertEqual(self.harness.charm.sources[j_rel_id]['version'], 2)
+
+    @mock.patch.object(GrafanaK8s, '_grafana_process_start_time',
+                       side_effect=time.time)
+    @mock.patch.object(GrafanaK8s, '_grafana_is_healthy', return_value=True)
+    def test__tombstones_kept_until_acknowledged(self, *_):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        self.harness.update_relation_data(db_rel_id,
+                                          'mysql/0',
+                                          {
+                                              'type': 'mysql',
+                                              'host': '0.1.2.3:3306',
+                                              'name': 'my-test-db',
+                                              'user': 'test-user',
+                                              'password': 'password',
+                                          })
+
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        self.harness.update_relation_data(rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'source-type': 'prometheus',
+        })
+        generation = self.harness.charm.datastore.restart_generation
+        self.harness.charm.on.update_status.emit()
+        self.harness.update_relation_data(peer_rel_id, 'grafana/1',
+                                          {'restart-ack': str(generation)})
+
+        # removing the source is rolled out as the next generation
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'private-address': None})
+        self.assertEqual(dict(self.harness.charm.datastore.tombstones),
+                         {'prometheus/0': generation + 1})
+
+        # grafana/1 did not apply it yet, so the tombstone must stay
+        self.assertFalse(self.harness.charm._compact_tombstones())
+        container = get_container(self.harness.get_pod_spec()[0], 'grafana')
+        self.assertIn('deleteDatasources',
+                      container['files'][0]['files']['datasources.yaml'])
+
+        self.harness.charm.on.update_status.emit()
+        self.harness.update_relation_data(peer_rel_id, 'grafana/1',
+                                          {'restart-ack': str(generation + 1)})
+        self.assertTrue(self.harness.charm._compact_tombstones())
+
+        # so a re-added source starts with a fresh version
+        self.assertEqual(dict(self.harness.charm.datastore.source_versions),
+                         {})
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'private-address': '192.0.2.1'})
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 1)
+
+    def test__leader_elected_rebuilds_datastore(self):
+        self.harness.update_config(BASE_CONFIG)
+
+        # relation data arrives while this unit is not the leader
+        p_rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(p_rel_id, 'prometheus/0')
+        self.harness.update_relation_data(p_rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'source-type': 'prometheus',
+        })
+        j_rel_id = self.harness.add_relation('grafana-source', 'jaeger')
+        self.harness.add_relation_unit(j_rel_id, 'jaeger/0')
+        self.harness.add_relation_unit(j_rel_id, 'jaeger/1')
+        self.harness.update_relation_data(j_rel_id, 'jaeger/1', {
+            'private-address': '192.0.2.2',
+            'port': '7890',
+            'source-type': 'jaeger',
+            'source-name': 'jaeger-application',
+        })
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        db_data = {
+            'type': 'mysql',
+            'host': '0.1.2.3:3306',
+            'name': 'my-test-db',
+            'user': 'test-user',
+            'password': 'password',
+        }
+        self.harness.update_relation_data(db_rel_id, 'mysql/0', db_data)
+        self.assertEqual(self.harness.charm.sources, {})
+        self.assertEqual(self.harness.charm.database, {})
+
+        self.harness.set_leader(True)
+        sources = self.harness.charm.sources
+        self.assertEqual(sorted(sources), [p_rel_id, j_rel_id])
+        self.assertEqual(sources[j_rel_id]['unit_name'], 'jaeger/1')
+        self.assertEqual(self.harness.charm.datastore.source_names,
+                         {'prometheus/0', 'jaeger-application'})
+        self.assertEqual(self.harness.charm.database, db_data)
+        datasources_yaml = get_container(
+            self.harness.get_pod_spec()[0],
+            'grafana')['files'][0]['files']['datasources.yaml']
+        self.assertIn('jaeger-application', datasources_yaml)
+        self.assertIn('prometheus/0', datasources_yaml)
+
+        # rebuilding again without changes keeps the versions and hashes
+        generation = self.harness.charm.datastore.restart_generation
+        self.harness.charm._rebuild_datastore_from_relations()
+        self.harness.charm.configure_pod()
+        self.assertEqual(self.harness.charm.sources[p_rel_id]['version'], 1)
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         generation)
+
+        # sources that vanished while this unit was not leader are deleted
+        with self.harness.hooks_disabled():
+            self.harness.update_relation_data(p_rel_id, 'prometheus/0',
+                                              {'port': None})
+        self.harness.charm._rebuild_datastore_from_relations()
+        self.assertEqual(sorted(self.harness.charm.sources), [j_rel_id])
+        self.assertIn('prometheus/0', self.harness.charm.datastore.tombstones)
+
+    def test__shared_state_encoding(self):
+        state = {'version': 1, 'sources': {'1': {'source-name': 'prom'}}}
+        text = encode_shared_state(state)
+        self.assertEqual(decode_shared_state(text), state)
+        self.assertEqual(encode_shared_state(dict(reversed(state.items()))),
+                         text)
+
+        self.assertEqual(decode_shared_state('not compressed'), {})
+        self.assertEqual(
+            decode_shared_state(encode_shared_state({'version': 0})), {})
+
+    def test__shared_state_published_to_peers(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        db_rel_id = self.harness.add_relation('database', 'mysql')
+        self.harness.add_relation_unit(db_rel_id, 'mysql/0')
+        db_data = {
+            'type': 'mysql',
+            'host': '0.1.2.3:3306',
+            'name': 'my-test-db',
+            'user': 'test-user',
+            'password': 'password',
+        }
+        self.harness.update_relation_data(db_rel_id, 'mysql/0', db_data)
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        self.harness.update_relation_data(rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'source-type': 'prometheus',
+        })
+
+        state = self.harness.charm._shared_state()
+        self.assertEqual(state['database'], db_data)
+        self.assertEqual(state['sources'][str(rel_id)]['source-name'],
+                         'prometheus/0')
+        self.assertEqual(state['restart_generation'],
+                         self.harness.charm.datastore.restart_generation)
+
+        # a non-leader knows about the database without its own state
+        self.harness.set_leader(False)
+        self.harness.charm.datastore.database = []
+        self.harness.charm.datastore.sources = {}
+        self.assertTrue(self.harness.charm.has_db)
+
+        # and takes over the published state when it becomes leader
+        self.harness.charm.datastore.restart_generation = 0
+        self.harness.set_leader(True)
+        self.assertEqual(self.harness.charm.database, db_data)
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 1)
+        self.assertEqual(self.harness.charm.datastore.restart_generation,
+                         state['restart_generation'])
+
+    def test__compact_source_records(self):
+        source = {
+            'source-name': 'prometheus/0',
+            'source-type': ''.join(['prom', 'etheus']),
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'unit_name': 'prometheus/0',
+            'version': 3,
+        }
+        record = pack_source(source)
+        self.assertEqual(record, ['prometheus/0', 'prometheus', '192.0.2.1',
+                                  '1234', None, 3])
+        self.assertIs(record[1], pack_source(dict(source))[1])
+        self.assertEqual(unpack_source(record), source)
+
+    def test__migrate_datastore_from_v1(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+
+        # layout written by the first versions of this charm
+        db_data = {
+            'type': 'mysql',
+            'host': '0.1.2.3:3306',
+            'name': 'my-test-db',
+            'user': 'test-user',
+            'password': 'password',
+        }
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        datastore = self.harness.charm.datastore
+        datastore.schema_version = 1
+        datastore.sources = {rel_id: {
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'source-name': 'prometheus-app',
+            'source-type': 'prometheus',
+            'isDefault': 'true',
+            'unit_name': 'prometheus/0',
+        }}
+        datastore.database = db_data
+        datastore.sources_to_delete = {'jaeger-app'}
+
+        self.harness.charm._migrate_datastore()
+        self.assertEqual(datastore.schema_version, 3)
+        self.assertEqual(datastore.default_source, 'prometheus-app')
+        self.assertEqual(self.harness.charm.sources, {rel_id: {
+            'private-address': '192.0.2.1',
+            'port': '1234',
+            'source-name': 'prometheus-app',
+            'source-type': 'prometheus',
+            'unit_name': 'prometheus/0',
+            'version': 1,
+        }})
+        self.assertEqual(self.harness.charm.database, db_data)
+        self.assertEqual(dict(datastore.tombstones), {'jaeger-app': 0})
+        self.assertEqual(set(datastore.sources_to_delete), set())
+        self.assertEqual(dict(datastore.source_versions),
+                         {'prometheus-app': 1})
+
+        # a changed source gets the next version
+        self.harness.update_relation_data(rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.2',
+            'port': '1234',
+            'source-name': 'prometheus-app',
+            'source-type': 'prometheus',
+        })
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 2)
+
+    def test__pod_spec_size_budget(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        self.assertEqual(self.harness.charm.unit.status,
+                         APPLICATION_ACTIVE_STATUS)
+
+        pod_spec = self.harness.get_pod_spec()[0]
+        total, file_sizes = pod_spec_size(pod_spec)
+        self.assertEqual(self.harness.charm.datastore.pod_spec_size, total)
+        self.assertEqual(sorted(file_sizes),
+                         ['grafana-config-ini', 'grafana-datasources'])
+        self.assertLess(sum(file_sizes.values()), total)
+
+        # a change that would push the spec over the budget is not set
+        self.harness.update_config({'pod_spec_size_budget': total})
+        self.harness.update_config({'grafana_log_level': 'debug'})
+        self.assertIsInstance(self.harness.charm.unit.status, BlockedStatus)
+        self.assertEqual(self.harness.get_pod_spec()[0], pod_spec)
+
+        self.harness.update_config({'pod_spec_size_budget': 2 * total})
+        self.assertEqual(self.harness.charm.unit.status,
+                         APPLICATION_ACTIVE_STATUS)
+
     def test__duplicate_source_names(self):
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
-        self.assertEqual(self.harness.charm.datastore.sources, {})
+        self.assertEqual(self.harness.charm.sources, {})
 
         # add first relation
         p_rel_id = self.harness.add_relation('grafana-source', 'prometheus')
@@ -497,10 +1367,10 @@ class GrafanaCharmTest(unittest.TestCase):
             'port': 4321,
             'source-name': 'duplicate-source-name',
             'source-type': 'prometheus',
-            'isDefault': 'true',
-            'unit_name': 'prometheus/0'
+            'unit_name': 'prometheus/0',
+            'version': 1,
         }
-        self.assertEqual(dict(self.harness.charm.datastore.sources[p_rel_id]),
+        self.assertEqual(self.harness.charm.sources[p_rel_id],
                          expected_source_data)
 
         # add second source with the same name as the first source
@@ -522,6 +1392,327 @@ class GrafanaCharmTest(unittest.TestCase):
         self.assertEqual(None, self.harness.charm.datastore.sources.get(p_rel_id))
         self.assertEqual(0, len(self.harness.charm.datastore.sources))
 
+    def test__batched_sources(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        rel_id = self.harness.add_relation('grafana-source', 'thanos')
+        self.harness.add_relation_unit(rel_id, 'thanos/0')
+        self.harness.add_relation_unit(rel_id, 'thanos/1')
+
+        def publish(*names, port=9090):
+            self.harness.update_relation_data(rel_id, 'thanos', {
+                'datasources': json.dumps([{
+                    'source-name': name,
+                    'source-type': 'prometheus',
+                    'private-address': '192.0.2.{}'.format(index),
+                    'port': port if index == 0 else 9090,
+                } for index, name in enumerate(names)])})
+
+        # the whole batch is applied in a single hook
+        with mock.patch.object(self.harness.charm, 'configure_pod') as configure:
+            publish('thanos-a', 'thanos-b', 'thanos-c')
+            configure.assert_called_once_with()
+        self.harness.charm.configure_pod()
+        self.assertEqual(sorted(self.harness.charm.sources), [
+            '{}/thanos-a'.format(rel_id),
+            '{}/thanos-b'.format(rel_id),
+            '{}/thanos-c'.format(rel_id),
+        ])
+        self.assertEqual(self.harness.charm.sources[
+            '{}/thanos-b'.format(rel_id)], {
+                'private-address': '192.0.2.1',
+                'port': '9090',
+                'source-type': 'prometheus',
+                'source-name': 'thanos-b',
+                'unit_name': 'thanos',
+                'version': 1,
+        })
+        datasources = self.harness.charm._make_data_source_config_text()
+        self.assertEqual(datasources.count('type: prometheus'), 3)
+
+        # only changed sources get a new version, missing ones are deleted
+        publish('thanos-a', 'thanos-b', port=9091)
+        versions = {source['source-name']: source['version']
+                    for source in self.harness.charm.sources.values()}
+        self.assertEqual(versions, {'thanos-a': 2, 'thanos-b': 1})
+        self.assertIn('thanos-c', self.harness.charm.datastore.tombstones)
+
+        # unit data and invalid batches don't change the published sources
+        sources = self.harness.charm.sources
+        self.harness.update_relation_data(rel_id, 'thanos/0', {
+            'private-address': '192.0.2.9',
+            'port': '1234',
+            'source-type': 'prometheus',
+        })
+        self.harness.update_relation_data(rel_id, 'thanos',
+                                          {'datasources': '{"not": "a list"'})
+        self.harness.charm._rebuild_datastore_from_relations()
+        self.assertEqual(self.harness.charm.sources, sources)
+
+        # the batch stays until the last unit departed
+        relation = self.harness.model.get_relation('grafana-source', rel_id)
+        self.harness.charm.on['grafana-source'].relation_departed.emit(
+            relation)
+        self.assertEqual(self.harness.charm.sources, sources)
+        relation.units.clear()
+        self.harness.charm.on['grafana-source'].relation_departed.emit(
+            relation)
+        self.assertEqual(self.harness.charm.sources, {})
+
+    def test__per_unit_source_upgraded_to_batch(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        self.harness.update_relation_data(rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.1',
+            'port': '9090',
+            'source-type': 'prometheus',
+            'source-name': 'prometheus-app',
+        })
+        self.assertEqual(list(self.harness.charm.sources), [rel_id])
+
+        # entries without a name are skipped, the per-unit source is
+        # replaced by the batch without deleting its name in Grafana
+        self.harness.update_relation_data(rel_id, 'prometheus', {
+            'datasources': json.dumps([
+                {'source-name': 'prometheus-app',
+                 'source-type': 'prometheus',
+                 'private-address': '192.0.2.1',
+                 'port': 9090},
+                {'source-type': 'prometheus',
+                 'private-address': '192.0.2.2',
+                 'port': 9090},
+            ])})
+        self.assertEqual(list(self.harness.charm.sources),
+                         ['{}/prometheus-app'.format(rel_id)])
+        self.assertNotIn('prometheus-app',
+                         self.harness.charm.datastore.tombstones)
+
+    @mock.patch.object(Model, 'name', new_callable=mock.PropertyMock,
+                       return_value='lma')
+    def test__source_url_mode_service(self, _):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        self.harness.add_relation_unit(rel_id, 'prometheus/1')
+        self.harness.update_relation_data(rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.1',
+            'port': '9090',
+            'source-type': 'prometheus',
+        })
+        self.assertEqual(self.harness.charm.sources[rel_id]['private-address'],
+                         '192.0.2.1')
+
+        # switching the mode rebuilds the source with the service address
+        self.harness.update_config({'source_url_mode': 'service'})
+        self.assertEqual(self.harness.charm.sources[rel_id], {
+            'private-address': 'prometheus.lma.svc',
+            'port': '9090',
+            'source-type': 'prometheus',
+            'source-name': 'prometheus',
+            'unit_name': 'prometheus',
+            'version': 1,
+        })
+
+        # other units don't change the data source or restart Grafana
+        pod_spec = self.harness.get_pod_spec()
+        self.harness.update_relation_data(rel_id, 'prometheus/1', {
+            'private-address': '192.0.2.2',
+            'port': '9090',
+            'source-type': 'prometheus',
+        })
+        self.assertEqual(self.harness.get_pod_spec(), pod_spec)
+        relation = self.harness.model.get_relation('grafana-source', rel_id)
+        self.harness.charm.on['grafana-source'].relation_departed.emit(
+            relation)
+        self.assertEqual(self.harness.get_pod_spec(), pod_spec)
+
+        # an explicit service address of the source takes precedence
+        self.harness.update_relation_data(rel_id, 'prometheus', {
+            'service-address': 'prometheus-lb.example.com'})
+        self.harness.update_relation_data(rel_id, 'prometheus/0',
+                                          {'port': '9091'})
+        self.assertEqual(self.harness.charm.sources[rel_id]['private-address'],
+                         'prometheus-lb.example.com')
+        self.assertEqual(self.harness.charm.sources[rel_id]['version'], 2)
+
+        self.harness.update_config({'source_url_mode': 'round-robin'})
+        self.assertEqual(self.harness.charm._check_config(),
+                         ['source_url_mode'])
+
+    @mock.patch.object(Model, 'name', new_callable=mock.PropertyMock,
+                       return_value='lma')
+    def test__source_url_mode_service_failover(self, _):
+        self.harness.set_leader(True)
+        self.harness.update_config(dict(BASE_CONFIG, source_url_mode='service'))
+        peer_rel_id = self.harness.add_relation('grafana', 'grafana')
+        self.harness.add_relation_unit(peer_rel_id, 'grafana/1')
+        rel_id = self.harness.add_relation('grafana-source', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        self.harness.update_relation_data(rel_id, 'prometheus/0', {
+            'private-address': '192.0.2.1',
+            'port': '9090',
+            'source-type': 'prometheus',
+        })
+        sources = self.harness.charm.sources
+
+        # a unit that was not the leader while the mode changed takes over
+        self.harness.set_leader(False)
+        self.harness.charm.datastore.source_url_mode = 'unit'
+        self.harness.set_leader(True)
+        self.assertEqual(self.harness.charm.sources, sources)
+        self.assertEqual(self.harness.charm.sources[rel_id]['private-address'],
+                         'prometheus.lma.svc')
+        self.assertEqual(dict(self.harness.charm.datastore.tombstones), {})
+
+    def test__probe_endpoints(self):
+        live_port, dead_port = start_stub_data_source(self), get_closed_port()
+        self.assertEqual(probe_endpoints([
+            ('127.0.0.1', live_port),
+            ('127.0.0.1', dead_port),
+            ('127.0.0.1', live_port),
+        ], timeout=1), {
+            ('127.0.0.1', live_port): True,
+            ('127.0.0.1', dead_port): False,
+        })
+        self.assertEqual(probe_endpoints([], timeout=1), {})
+
+    def test__datasource_validation(self):
+        live_port, dead_port = start_stub_data_source(self), get_closed_port()
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        self.harness.update_config({'datasource_validation': 'mark'})
+        for app, port in (('prometheus', live_port), ('jaeger', dead_port)):
+            rel_id = self.harness.add_relation('grafana-source', app)
+            self.harness.add_relation_unit(rel_id, '{}/0'.format(app))
+            self.harness.update_relation_data(rel_id, '{}/0'.format(app), {
+                'private-address': '127.0.0.1',
+                'port': str(port),
+                'source-type': app,
+                'source-name': app,
+            })
+
+        # marked sources are still provisioned
+        self.assertEqual(
+            self.harness.charm.unit.status.message,
+            'Grafana pod ready. Unreachable data sources: jaeger')
+        datasources = self.harness.charm._make_data_source_config_text()
+        self.assertIn('name: jaeger', datasources)
+
+        # held back sources are not, the default moves to the next one
+        self.harness.update_config({'datasource_validation': 'hold'})
+        self.assertEqual(
+            self.harness.charm.unit.status.message,
+            'Grafana pod ready. Held back unreachable data sources: jaeger')
+        datasources = self.harness.charm._make_data_source_config_text()
+        self.assertNotIn('name: jaeger', datasources)
+        self.assertIn('name: prometheus', datasources)
+        self.assertIn('isDefault: true', datasources)
+
+        # results are cached until their TTL expired
+        with mock.patch('charm.probe_endpoint') as probe:
+            self.assertFalse(self.harness.charm._probe_sources())
+            probe.assert_not_called()
+            self.harness.update_config({'datasource_probe_ttl': 0})
+            probe.return_value = True
+            self.harness.charm.on.update_status.emit()
+            probe.assert_any_call('127.0.0.1', str(dead_port), 2)
+        self.assertIn('name: jaeger',
+                      self.harness.charm._make_data_source_config_text())
+        self.assertEqual(self.harness.charm.unit.status,
+                         APPLICATION_ACTIVE_STATUS)
+
+        self.harness.update_config({'datasource_validation': 'strict'})
+        self.assertEqual(self.harness.charm._check_config(),
+                         ['datasource_validation'])
+
+    def test__query_cache_sidecar(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        for app, port in (('prometheus', '9090'), ('jaeger', '16686')):
+            rel_id = self.harness.add_relation('grafana-source', app)
+            self.harness.add_relation_unit(rel_id, '{}/0'.format(app))
+            self.harness.update_relation_data(rel_id, '{}/0'.format(app), {
+                'private-address': '192.0.2.1',
+                'port': port,
+                'source-type': app,
+                'source-name': '{} app'.format(app),
+            })
+        self.assertEqual(len(self.harness.get_pod_spec()[0]['containers']), 1)
+
+        self.harness.update_config({'query_cache_enabled': True,
+                                    'query_cache_ttl': 15})
+        pod_spec = self.harness.get_pod_spec()[0]
+        sidecar = get_container(pod_spec, 'query-cache')
+        self.assertEqual(sidecar['command'], [
+            'python3',
+            '/etc/grafana-query-cache/query_cache.py',
+            '/etc/grafana-query-cache/config.json',
+        ])
+        files = sidecar['files'][0]['files']
+        self.assertIn('class ResponseCache', files['query_cache.py'])
+        self.assertEqual(json.loads(files['config.json']), {
+            'port': 3001,
+            'max_bytes': 64 * 1024 * 1024,
+            'ttl': 15,
+            'upstreams': {'prometheus app': 'http://192.0.2.1:9090'},
+        })
+
+        # only Prometheus is queried through the sidecar
+        datasources = get_container(pod_spec, 'grafana')['files'][0][
+            'files']['datasources.yaml']
+        self.assertIn('url: http://localhost:3001/prometheus%20app\n',
+                      datasources)
+        self.assertIn('url: http://192.0.2.1:16686\n', datasources)
+
+        # cache settings restart the pods through the sidecar's hash
+        config_hash = sidecar['config']['QUERY_CACHE_CONFIG']
+        self.assertEqual(
+            self.harness.charm.datastore.config_hashes['QUERY_CACHE_CONFIG'],
+            config_hash)
+        self.harness.update_config({'query_cache_size': 128})
+        sidecar = get_container(self.harness.get_pod_spec()[0], 'query-cache')
+        self.assertNotEqual(sidecar['config']['QUERY_CACHE_CONFIG'],
+                            config_hash)
+
+        self.harness.update_config({'query_cache_port': 3000,
+                                    'query_cache_ttl': 0})
+        self.assertEqual(self.harness.charm._check_config(),
+                         ['query_cache_port', 'query_cache_ttl'])
+
+    def test__query_cache_toggle_bumps_versions(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(BASE_CONFIG)
+        for app, port in (('prometheus', '9090'), ('jaeger', '16686')):
+            rel_id = self.harness.add_relation('grafana-source', app)
+            self.harness.add_relation_unit(rel_id, '{}/0'.format(app))
+            self.harness.update_relation_data(rel_id, '{}/0'.format(app), {
+                'private-address': '192.0.2.1',
+                'port': port,
+                'source-type': app,
+                'source-name': app,
+            })
+
+        def versions():
+            return {source['source-name']: source['version']
+                    for source in self.harness.charm.sources.values()}
+
+        # Grafana only applies the changed Prometheus URL with a new version
+        self.assertEqual(versions(), {'prometheus': 1, 'jaeger': 1})
+        self.harness.update_config({'query_cache_enabled': True})
+        self.assertEqual(versions(), {'prometheus': 2, 'jaeger': 1})
+        datasources = self.harness.charm._make_data_source_config_text()
+        self.assertIn('url: http://localhost:3001/prometheus\n'
+                      '  isDefault: true\n'
+                      '  editable: true\n'
+                      '  orgId: 1\n'
+                      '  version: 2\n', datasources)
+
+        self.harness.update_config({'query_cache_enabled': False})
+        self.assertEqual(versions(), {'prometheus': 3, 'jaeger': 1})
+
     def test__idempotent_datasource_file_hash(self):
         self.harness.set_leader(True)
         self.harness.update_config(BASE_CONFIG)
@@ -0,0 +1,48 @@
+import logging
+import unittest
+
+from tests.load_simulator import LoadSimulator, percentile, simulate
+
+
+class LoadSimulatorTest(unittest.TestCase):
+
+    def test__percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.95), 0.0)
+
+    def test__simulate_relation_churn(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        results = simulate(150, seed=1)
+        self.assertEqual(sum(results['events'].values()), 150)
+        self.assertGreater(results['set_spec_calls'], 0)
+        self.assertGreater(results['events']['leader_change'], 0)
+        self.assertGreater(results['related_sources'], 0)
+        self.assertEqual(results['sources'], results['related_sources'])
+
+        # every restart comes from a set_spec call, but not the other way
+        self.assertLessEqual(results['restarts'], results['set_spec_calls'])
+        self.assertLessEqual(results['latency_p50'], results['latency_p95'])
+        self.assertLessEqual(results['latency_p95'], results['latency_p99'])
+        self.assertGreater(results['state_size_after'],
+                           results['state_size_before'])
+
+    def test__departed_sources_stay_gone_after_failover(self):
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        simulator = LoadSimulator()
+        self.addCleanup(simulator.harness.cleanup)
+
+        simulator.source_join()
+        simulator.source_join()
+        simulator.source_depart()
+        simulator.leader_change()
+        datastore = simulator.harness.charm.datastore
+        self.assertEqual(
+            sorted(source['source-name']
+                   for source in simulator.harness.charm.sources.values()),
+            sorted(unit.split('/')[0] for unit in simulator.sources.values()))
+        self.assertEqual(len(datastore.tombstones), 1)
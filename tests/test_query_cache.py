@@ -0,0 +1,119 @@
+import http.server
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from query_cache import ResponseCache, make_server
+
+
+class StubPrometheus(http.server.BaseHTTPRequestHandler):
+    """Answers queries with the request path and body, and counts them."""
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self._answer(b'')
+
+    def do_POST(self):
+        self._answer(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def _answer(self, body):
+        self.requests.append(self.path)
+        if self.path.startswith('/broken'):
+            self.send_error(500)
+            return
+        text = '{} {}'.format(self.path, body.decode()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(test_case, server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return server.server_address[1]
+
+
+class QueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        StubPrometheus.requests = []
+        upstream_port = serve(self, http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StubPrometheus))
+        self.server = make_server({
+            'port': 0,
+            'max_bytes': 1024,
+            'ttl': 60,
+            'upstreams': {
+                'prometheus a': 'http://127.0.0.1:{}'.format(upstream_port),
+            },
+        })
+        self.url = 'http://127.0.0.1:{}/{}'.format(
+            serve(self, self.server), urllib.parse.quote('prometheus a'))
+
+    def request(self, path, body=None):
+        try:
+            with urllib.request.urlopen(self.url + path, data=body) as r:
+                return r.status, r.headers['X-Cache'], r.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers['X-Cache'], e.read().decode()
+
+    def test__repeated_queries_are_cached(self):
+        path = '/api/v1/query_range?query=up&start=0&end=60&step=15'
+        self.assertEqual(self.request(path),
+                         (200, 'MISS', '{} '.format(path)))
+        self.assertEqual(self.request(path),
+                         (200, 'HIT', '{} '.format(path)))
+        self.assertEqual(len(StubPrometheus.requests), 1)
+
+        # POST queries are cached by their body
+        for body in (b'query=up', b'query=up', b'query=down'):
+            status, _, text = self.request('/api/v1/query', body)
+            self.assertEqual(text, '/api/v1/query {}'.format(body.decode()))
+        self.assertEqual(StubPrometheus.requests[1:],
+                         ['/api/v1/query', '/api/v1/query'])
+
+    def test__errors_are_not_cached(self):
+        self.assertEqual(self.request('/broken')[0], 500)
+        self.assertEqual(self.request('/broken')[:2], (500, 'MISS'))
+        self.assertEqual(len(StubPrometheus.requests), 2)
+
+        self.url = self.url.rsplit('/', 1)[0] + '/unknown'
+        self.assertEqual(self.request('/api/v1/query')[0], 404)
+
+        self.server.upstreams['unknown'] = 'http://127.0.0.1:1'
+        self.assertEqual(self.request('/api/v1/query')[0], 502)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test__ttl_and_size_limit(self):
+        now = [0]
+        cache = ResponseCache(max_bytes=10, ttl=30, clock=lambda: now[0])
+        cache.put('a', (200, {}, b'aaaa'))
+        cache.put('b', (200, {}, b'bbbb'))
+        self.assertEqual(cache.get('a'), (200, {}, b'aaaa'))
+
+        # the least recently used response is evicted first
+        cache.put('c', (200, {}, b'cccc'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 8)
+
+        # responses larger than the cache are not stored
+        cache.put('d', (200, {}, b'd' * 11))
+        self.assertEqual(len(cache), 2)
+
+        now[0] = 30
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
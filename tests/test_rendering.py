@@ -0,0 +1,74 @@
+import hashlib
+import unittest
+
+from hypothesis import given, settings, strategies as st
+from ops.testing import Harness
+
+from charm import GrafanaK8s, get_container
+from tests.test_charm import BASE_CONFIG
+
+source_names = st.text(alphabet='abcdefghijklmnopqrstuvwxyz-', min_size=1,
+                       max_size=12)
+
+# a set of uniquely named data sources, some of which will be removed again
+sources = st.lists(
+    st.fixed_dictionaries({
+        'source-name': source_names,
+        'source-type': st.sampled_from(['prometheus', 'graphite', 'jaeger']),
+        'private-address': st.ip_addresses(v=4).map(str),
+        'port': st.integers(min_value=1, max_value=65535).map(str),
+        'remove': st.booleans(),
+    }),
+    min_size=1, max_size=6, unique_by=lambda source: source['source-name'])
+
+
+def render(source_list):
+    """Relate the sources in the given order, remove some of them (also in
+    the given order) and return the hashes of the settled pod spec."""
+    harness = Harness(GrafanaK8s)
+    harness.begin()
+    harness.set_leader(True)
+    harness.update_config(BASE_CONFIG)
+
+    rel_ids = {}
+    for source in source_list:
+        app = source['source-name']
+        rel_id = harness.add_relation('grafana-source', app)
+        harness.add_relation_unit(rel_id, '{}/0'.format(app))
+        harness.update_relation_data(rel_id, '{}/0'.format(app), {
+            field: value for field, value in source.items()
+            if field != 'remove'})
+        rel_ids[app] = rel_id
+
+    for source in source_list:
+        if source['remove']:
+            app = source['source-name']
+            harness.update_relation_data(rel_ids[app], '{}/0'.format(app),
+                                         {'private-address': None})
+
+    # once all deletions are applied, render both files again
+    harness.charm._compact_tombstones()
+    harness.charm.configure_pod()
+    container = get_container(harness.get_pod_spec()[0], 'grafana')
+    datasources_yaml = container['files'][0]['files']['datasources.yaml']
+    file_hash = hashlib.md5(datasources_yaml.encode()).hexdigest()
+    assert file_hash == container['config']['DATASOURCES_YAML']
+    harness.cleanup()
+    return dict(container['config'])
+
+
+class DeterministicRenderingTest(unittest.TestCase):
+
+    @settings(max_examples=25, deadline=None)
+    @given(source_list=sources, data=st.data())
+    def test__hashes_do_not_depend_on_event_order(self, source_list, data):
+        # the first source becomes the default one, the rest may be
+        # related in any order
+        shuffled = source_list[:1] + data.draw(
+            st.permutations(source_list[1:]))
+        self.assertEqual(render(source_list), render(shuffled))
+
+    @settings(max_examples=10, deadline=None)
+    @given(source_list=sources)
+    def test__rerendering_keeps_hashes(self, source_list):
+        self.assertEqual(render(source_list), render(source_list))